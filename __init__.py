@@ -9,9 +9,20 @@ def register():
         sale.Cron,
         sale.Sale,
         sale.Configuration,
+        sale.SaleLineIgnoredMove,
+        sale.Move,
+        sale.ShipmentOut,
+        sale.ShipmentOutReturn,
+        sale.Invoice,
         sale.SaleRevokeStart,
+        sale.SaleRevokePlan,
+        sale.SaleCreatePendingMovesStart,
+        sale.SaleRevokeLog,
+        sale.SaleRevokeRun,
+        sale.SaleRevokeRunLine,
         module='sale_revoke', type_='model')
     Pool.register(
         sale.SaleRevoke,
+        sale.SaleFixException,
         sale.SaleCreatePendingMoves,
         module='sale_revoke', type_='wizard')
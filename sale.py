@@ -1,19 +1,144 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import json
 import logging
-from datetime import timedelta
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
+from sql import For, Null, Select, Union
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.operators import Concat
+
+from trytond import backend
+from trytond.ir.cron import str2bigint
 from trytond.pool import Pool, PoolMeta
-from trytond.model import ModelView
+from trytond.model import Index, ModelSQL, ModelView
 from trytond.model import fields
-from trytond.transaction import Transaction, TransactionError
+from trytond.tools import grouped_slice
+from trytond.transaction import (
+    Transaction, TransactionError, record_cache_size, without_check_access)
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.protocols.jsonrpc import JSONDecoder
 from trytond.pyson import Bool, Eval
 from trytond.wizard import (
     Button, StateAction, StateTransition, StateView, Wizard)
 
 logger = logging.getLogger(__name__)
 
+BACKEND_LOGGERS = [
+    'trytond.backend.postgresql.database',
+    'trytond.backend.sqlite.database',
+    ]
+_revoke_phases = ContextVar('sale_revoke_phases', default=None)
+# Delay before retrying the sales locked by another transaction
+LOCK_RETRY_DELAY = timedelta(minutes=5)
+# Maximum delay in days before fixing again a failed exception sale
+MAX_RETRY_DAYS = 64
+
+
+@contextmanager
+def savepoint(name):
+    "Roll back the changes made in the block to its start if it fails"
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    tasks = len(transaction.tasks)
+    log_records = len(transaction.log_records)
+    create_records = {
+        k: len(v) for k, v in transaction.create_records.items()}
+    delete_records = {
+        k: v.copy() for k, v in transaction.delete_records.items()}
+    trigger_records = {
+        k: v.copy() for k, v in transaction.trigger_records.items()}
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except BaseException:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        del transaction.tasks[tasks:]
+        del transaction.log_records[log_records:]
+        for model, ids in list(transaction.create_records.items()):
+            del ids[create_records.get(model, 0):]
+        transaction.delete_records.clear()
+        transaction.delete_records.update(delete_records)
+        transaction.trigger_records.clear()
+        transaction.trigger_records.update(trigger_records)
+        # Invalidate the records cached inside the savepoint
+        for cache in transaction.cache.values():
+            cache.clear()
+        transaction.counter += 1
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+class QueryCounter(logging.Handler):
+    "Count the queries logged by the database backends in the current thread"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.thread = threading.get_ident()
+        self.count = 0
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.count += 1
+
+
+@contextmanager
+def revoke_phase(phase, sales):
+    "Measure the duration, queries and records of a phase of the revoke"
+    loggers = [logging.getLogger(n) for n in BACKEND_LOGGERS]
+    loggers = [l for l in loggers if l.isEnabledFor(logging.DEBUG)]
+    counter = QueryCounter()
+    for backend_logger in loggers:
+        backend_logger.addHandler(counter)
+    stats = {
+        'phase': phase,
+        'sale': sales[0].id if len(sales) == 1 else None,
+        'sale_ids': [s.id for s in sales],
+        'sales': len(sales),
+        'records': len(sales),
+        'queries': None,
+        'duration': None,
+        'failed': False,
+        }
+    start = time.perf_counter()
+    try:
+        yield stats
+    except BaseException:
+        stats['failed'] = True
+        raise
+    finally:
+        stats['duration'] = round(time.perf_counter() - start, 3)
+        for backend_logger in loggers:
+            backend_logger.removeHandler(counter)
+        if loggers:
+            stats['queries'] = counter.count
+        logger.info("Phase %(phase)s: %(sales)s sales, %(records)s records, "
+            "%(queries)s queries in %(duration).3fs", stats,
+            extra={'sale_revoke': stats})
+        phases = _revoke_phases.get()
+        if phases is not None:
+            phases.append(stats)
+
+
+@contextmanager
+def revoke_phases(operation):
+    "Collect the phases run in the block and store them when it succeeds"
+    phases = []
+    token = _revoke_phases.set(phases)
+    try:
+        yield phases
+    finally:
+        _revoke_phases.reset(token)
+    Pool().get('sale.revoke.log').store(operation, phases)
+
 
 class Cron(metaclass=PoolMeta):
     __name__ = 'ir.cron'
@@ -30,17 +155,103 @@ class Configuration(metaclass=PoolMeta):
     __name__ = 'sale.configuration'
 
     sale_exception_margin = fields.Integer('Sale exception margin (days)')
+    sale_exception_batch_size = fields.Integer('Sale exception batch size',
+        help='Number of exception sales handled by each queued task.')
+    sale_exception_max_sales = fields.Integer(
+        'Sale exception maximum sales per run',
+        help='Leave empty to handle all the exception sales on each run.')
+    sale_exception_shards = fields.Integer('Sale exception shards',
+        help='Split the exception sales of each partition into this number '
+        'of runs by sale id so the queue workers fix them in parallel.')
+    sale_exception_max_attempts = fields.Integer(
+        'Sale exception maximum attempts',
+        help='Number of failed fixes after which a sale is parked for '
+        'manual review.\nLeave empty to retry the sales forever.')
+    sale_exception_partition = fields.Selection([
+            (None, ''),
+            ('company', 'Company'),
+            ('warehouse', 'Company and Warehouse'),
+            ], 'Sale exception partition',
+        help='Split the exception sales into independent queued runs.\n'
+        'Leave empty to partition by company.')
+    sale_exception_schedule = fields.Boolean('Schedule Sale Exception Fixes',
+        help='Queue the fix of a sale when it gets an exception to run after '
+        'the margin instead of waiting for the cron.')
+    sale_pending_moves_only_pending_lines = fields.Boolean(
+        'Pending Moves Only for Pending Lines',
+        help='Copy only the lines with ignored moves when creating the '
+        'pending moves of a sale.')
+    sale_revoke_log = fields.Boolean('Log Revoke Phases',
+        help='Store the duration, queries and records touched by each phase '
+        'of the revokes and exception fixes.')
 
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
 
     ignored_moves = fields.Function(fields.Many2Many('stock.move', None, None,
-        'Ignored Moves'), 'get_ignored_moves')
+        'Ignored Moves'), 'get_ignored_moves', searcher='search_ignored_moves')
+    revoke_state = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'Revoke State', readonly=True,
+        states={
+            'invisible': ~Eval('revoke_state'),
+            })
+    revocation_status = fields.Selection([
+            (None, ''),
+            ('revocable', 'Revocable'),
+            ('blocked_moves', 'Blocked by Moves'),
+            ('blocked_invoices', 'Blocked by Invoices'),
+            ('ignored_moves', 'Has Ignored Moves'),
+            ], 'Revocation Status', readonly=True,
+        help='Updated when the shipments, moves and invoices of the sale '
+        'change.')
+    exception_attempts = fields.Integer('Exception Fix Attempts',
+        readonly=True,
+        help='Number of consecutive failed fixes of the exception.')
+    exception_failure = fields.Selection([
+            (None, ''),
+            ('process', 'Process'),
+            ('validation', 'Validation'),
+            ('shipment', 'Shipment'),
+            ('invoice', 'Invoice'),
+            ], 'Last Exception Fix Failure', readonly=True,
+        states={
+            'invisible': ~Eval('exception_failure'),
+            })
+    exception_retry_date = fields.Date('Next Exception Fix', readonly=True,
+        states={
+            'invisible': ~Eval('exception_retry_date'),
+            },
+        help='The exception is not fixed before this date.')
+    exception_fingerprint = fields.Timestamp('Exception Fingerprint',
+        readonly=True,
+        help='The last change of the lines, moves, shipments and invoices '
+        'when the fix failed.\n'
+        'The exception is not fixed again until one of them changes.')
 
     @classmethod
     def __setup__(cls):
         super(Sale, cls).__setup__()
+        t = cls.__table__()
+        # Match the domain and order of sale_exception_fix_cron
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.company, Index.Equality()),
+                (t.sale_date, Index.Range()),
+                (t.id, Index.Range()),
+                where=(t.state == 'processing')
+                & ((t.invoice_state == 'exception')
+                    | (t.shipment_state == 'exception'))))
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.revocation_status, Index.Equality()),
+                where=t.revocation_status != Null))
         cls._transitions |= set((
                 ('confirmed', 'done'),
                 ))
@@ -56,174 +267,1093 @@ class Sale(metaclass=PoolMeta):
                         | ~Bool(Eval('ignored_moves', []))),
                     'depends': ['state', 'ignored_moves'],
                     },
+                'reset_exception_attempts': {
+                    'invisible': ~Eval('exception_attempts', 0),
+                    'depends': ['exception_attempts'],
+                    'icon': 'tryton-refresh',
+                    },
+                'fix_exception': {
+                    'invisible': ((Eval('state') != 'processing')
+                        | ((Eval('invoice_state') != 'exception')
+                            & (Eval('shipment_state') != 'exception'))),
+                    'depends': ['state', 'invoice_state', 'shipment_state'],
+                    'icon': 'tryton-launch',
+                    },
                 })
 
+    @classmethod
+    def __register__(cls, module):
+        sale = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module)
+        fill_revocation_status = not table_h.column_exist('revocation_status')
+
+        super().__register__(module)
+
+        if fill_revocation_status:
+            cursor.execute(*sale.select(sale.id,
+                    where=sale.state.in_(['confirmed', 'processing', 'done'])))
+            for sub_ids in grouped_slice(
+                    [i for i, in cursor.fetchall()],
+                    backend.MAX_QUERY_PARAMS):
+                cls.update_revocation_status(list(sub_ids))
+
+    @staticmethod
+    def default_exception_attempts():
+        return 0
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('revoke_state', None)
+        default.setdefault('revocation_status', None)
+        default.setdefault('exception_attempts', 0)
+        default.setdefault('exception_failure', None)
+        default.setdefault('exception_retry_date', None)
+        default.setdefault('exception_fingerprint', None)
+        return super().copy(sales, default=default)
+
+    @classmethod
+    def on_modification(cls, mode, sales, field_names=None):
+        super().on_modification(mode, sales, field_names=field_names)
+        if mode == 'write' and 'state' in (field_names or {'state'}):
+            cls.update_revocation_status(sales)
+
+    @classmethod
+    def on_write(cls, sales, values):
+        callbacks = super().on_write(sales, values)
+        states = {values.get('shipment_state'), values.get('invoice_state')}
+        if 'exception' in states:
+            sales = [s for s in sales
+                if 'exception' not in {s.shipment_state, s.invoice_state}]
+            if sales:
+                callbacks.append(
+                    lambda: cls._schedule_sale_exceptions(sales))
+        return callbacks
+
+    @classmethod
+    def update_revocation_status(cls, sales):
+        "Store the revocation status of the sales that changed"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        LineIgnoredMove = pool.get('sale.line-ignored-stock.move')
+        sale = cls.__table__()
+        line = Line.__table__()
+        ignored = LineIgnoredMove.__table__()
+        cursor = Transaction().connection.cursor()
+
+        to_update = defaultdict(list)
+        for sub_ids in grouped_slice(
+                sorted({int(s) for s in sales}), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cursor.execute(*sale.select(
+                    sale.id, sale.state, sale.revocation_status,
+                    where=fields.SQL_OPERATORS['in'](sale.id, sub_ids)))
+            rows = cursor.fetchall()
+            cursor.execute(*line.join(ignored,
+                    condition=ignored.sale_line == line.id).select(
+                    line.sale,
+                    where=fields.SQL_OPERATORS['in'](line.sale, sub_ids),
+                    group_by=[line.sale]))
+            with_ignored = {i for i, in cursor}
+            blockers = cls.get_revoke_blockers(cls.browse([
+                        i for i, state, _ in rows
+                        if state in {'confirmed', 'processing'}]))
+            for sale_id, state, current in rows:
+                status = None
+                if state in {'confirmed', 'processing'}:
+                    blocker = blockers.get(sale_id)
+                    if blocker and blocker['invoices'] and not any(
+                            blocker[k] for k in [
+                                'moves', 'shipments', 'shipment_returns']):
+                        status = 'blocked_invoices'
+                    elif blocker:
+                        status = 'blocked_moves'
+                    elif sale_id in with_ignored:
+                        status = 'ignored_moves'
+                    else:
+                        status = 'revocable'
+                elif state == 'done' and sale_id in with_ignored:
+                    status = 'ignored_moves'
+                if status != current:
+                    to_update[status].append(sale_id)
+        for status, ids in to_update.items():
+            for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*sale.update(
+                        [sale.revocation_status], [status],
+                        where=fields.SQL_OPERATORS['in'](
+                            sale.id, list(sub_ids))))
+
     @classmethod
     def get_ignored_moves(cls, sales, name):
-        res = dict((x.id, None) for x in sales)
-        for sale in sales:
-            moves = []
-            for line in sale.lines:
-                moves += [m.id for m in line.moves_ignored]
-            res[sale.id] = moves
+        pool = Pool()
+        Line = pool.get('sale.line')
+        LineIgnoredMove = pool.get('sale.line-ignored-stock.move')
+        line = Line.__table__()
+        ignored = LineIgnoredMove.__table__()
+        cursor = Transaction().connection.cursor()
+
+        res = dict((x.id, []) for x in sales)
+        for sub_ids in grouped_slice(list(res), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(ignored,
+                    condition=ignored.sale_line == line.id).select(
+                    line.sale, ignored.move,
+                    where=fields.SQL_OPERATORS['in'](line.sale, list(sub_ids)),
+                    order_by=[line.sale, ignored.move]))
+            for sale_id, move_id in cursor:
+                res[sale_id].append(move_id)
         return res
 
+    @classmethod
+    def search_ignored_moves(cls, name, clause):
+        pool = Pool()
+        Line = pool.get('sale.line')
+        LineIgnoredMove = pool.get('sale.line-ignored-stock.move')
+        line = Line.__table__()
+        ignored = LineIgnoredMove.__table__()
+
+        _, operator, value = clause[:3]
+        if operator in {'=', '!='} and value is None:
+            query = line.join(ignored,
+                condition=ignored.sale_line == line.id).select(line.sale)
+            return [('id', 'in' if operator == '!=' else 'not in', query)]
+        nested = clause[0][len(name):]
+        return [('lines.moves_ignored' + nested, *clause[1:])]
+
     @classmethod
     @ModelView.button_action('sale_revoke.wizard_revoke')
     def revoke(cls, sales):
         pass
 
     @classmethod
-    def _check_moves(cls, sale):
-        moves = []
-        for key in [('shipments', 'inventory_moves'),
-                ('shipment_returns', 'incoming_moves')]:
-            shipments, shipment_moves = key[0], key[1]
-            for shipment in getattr(sale, shipments):
-                for move in getattr(shipment, shipment_moves):
-                    if move.state not in ('cancelled', 'draft', 'done'):
-                        moves.append(move)
-        return moves
+    def get_revoke_blockers(cls, sales, moves=True, invoices=True):
+        "Return the records which block the revoke of each sale"
+        # Extend to change which sales can be revoked, the validations, the
+        # plan and the revocation status all rely on it
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        ShipmentReturn = pool.get('stock.shipment.out.return')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        line = Line.__table__()
+        move = Move.__table__()
+        shipment_move = Move.__table__()
+        shipment = Shipment.__table__()
+        shipment_return = ShipmentReturn.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        blockers = defaultdict(lambda: defaultdict(set))
+        origin = Concat(Line.__name__ + ',', line.id)
+        line_moves = line.join(move, condition=move.origin == origin)
+        shipments = [
+            ('shipments', Shipment, shipment,
+                shipment_move.to_location == shipment.warehouse_output),
+            ('shipment_returns', ShipmentReturn, shipment_return,
+                (shipment_return.warehouse_input
+                    == shipment_return.warehouse_storage)
+                | (shipment_move.to_location
+                    == shipment_return.warehouse_input)),
+            ]
+        for sub_ids in grouped_slice(
+                [s.id for s in sales], backend.MAX_QUERY_PARAMS):
+            where = fields.SQL_OPERATORS['in'](line.sale, list(sub_ids))
+            for key, Model, table, condition in shipments if moves else []:
+                query = (line_moves
+                    .join(table, condition=move.shipment == Concat(
+                            Model.__name__ + ',', table.id))
+                    .join(shipment_move, 'LEFT',
+                        condition=(shipment_move.shipment == move.shipment)
+                        & condition
+                        & ~shipment_move.state.in_(
+                            ['cancelled', 'draft', 'done']))
+                    .select(
+                        line.sale, table.id, table.state, shipment_move.id,
+                        where=where,
+                        group_by=[
+                            line.sale, table.id, table.state,
+                            shipment_move.id]))
+                cursor.execute(*query)
+                for sale_id, shipment_id, state, move_id in cursor:
+                    if state not in {'cancelled', 'waiting', 'draft', 'done'}:
+                        blockers[sale_id][key].add(shipment_id)
+                    if move_id:
+                        blockers[sale_id]['moves'].add(move_id)
+            if invoices:
+                query = (line
+                    .join(invoice_line,
+                        condition=invoice_line.origin == origin)
+                    .join(invoice,
+                        condition=invoice_line.invoice == invoice.id)
+                    .select(line.sale, invoice.id,
+                        where=where & ~invoice.state.in_(
+                            ['cancelled', 'draft', 'posted', 'paid']),
+                        group_by=[line.sale, invoice.id]))
+                cursor.execute(*query)
+                for sale_id, invoice_id in cursor:
+                    blockers[sale_id]['invoices'].add(invoice_id)
+
+        keys = ['moves', 'shipments', 'shipment_returns', 'invoices']
+        return {
+            sale_id: {k: sorted(blocker[k]) for k in keys}
+            for sale_id, blocker in blockers.items()
+            if any(blocker.values())}
+
+    @classmethod
+    def get_revoke_plan(cls, sales, invoices=True):
+        "Return what revoking each sale would do without writing anything"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        ShipmentReturn = pool.get('stock.shipment.out.return')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        SaleIgnoredInvoice = pool.get('sale.sale-ignored-account.invoice')
+        SaleRecreatedInvoice = pool.get(
+            'sale.sale-recreated-account.invoice')
+        line = Line.__table__()
+        move = Move.__table__()
+        shipment = Shipment.__table__()
+        shipment_return = ShipmentReturn.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        ignored = SaleIgnoredInvoice.__table__()
+        recreated = SaleRecreatedInvoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = ['shipments_draft', 'shipments_cancel',
+            'shipment_returns_cancel', 'invoices_cancel', 'moves_ignore',
+            'invoices_ignore']
+        plan = {s.id: dict({k: set() for k in keys}, blocked=False)
+            for s in sales}
+        blockers = cls.get_revoke_blockers(sales, invoices=invoices)
+        for sale_id in blockers:
+            plan[sale_id]['blocked'] = True
+        sales = [s for s in sales if s.id not in blockers]
+        origin = Concat(Line.__name__ + ',', line.id)
+        line_moves = line.join(move, condition=move.origin == origin)
+        for sub_ids in grouped_slice(
+                [s.id for s in sales], backend.MAX_QUERY_PARAMS):
+            where = fields.SQL_OPERATORS['in'](line.sale, list(sub_ids))
+            for Model, table in [
+                    (Shipment, shipment),
+                    (ShipmentReturn, shipment_return)]:
+                cursor.execute(*line_moves
+                    .join(table, condition=move.shipment == Concat(
+                            Model.__name__ + ',', table.id))
+                    .select(line.sale, table.id, table.state, move.id,
+                        move.state, where=where))
+                for sale_id, shipment_id, state, move_id, move_state in (
+                        cursor):
+                    actions = plan[sale_id]
+                    if Model == Shipment:
+                        if state == 'waiting':
+                            actions['shipments_draft'].add(shipment_id)
+                        if state not in {'waiting', 'draft'}:
+                            continue
+                        actions['shipments_cancel'].add(shipment_id)
+                    else:
+                        if state != 'draft':
+                            continue
+                        actions['shipment_returns_cancel'].add(shipment_id)
+                    if move_state not in {'done', 'cancelled'}:
+                        actions['moves_ignore'].add(move_id)
+
+            if invoices:
+                cursor.execute(*line
+                    .join(invoice_line,
+                        condition=invoice_line.origin == origin)
+                    .join(invoice,
+                        condition=invoice_line.invoice == invoice.id)
+                    .join(ignored, 'LEFT',
+                        condition=(ignored.sale == line.sale)
+                        & (ignored.invoice == invoice.id))
+                    .join(recreated, 'LEFT',
+                        condition=(recreated.sale == line.sale)
+                        & (recreated.invoice == invoice.id))
+                    .select(line.sale, invoice.id, invoice.state,
+                        where=where
+                        & invoice.state.in_(['draft', 'cancelled'])
+                        & (ignored.id == Null) & (recreated.id == Null),
+                        group_by=[line.sale, invoice.id, invoice.state]))
+                for sale_id, invoice_id, state in cursor:
+                    if state == 'draft':
+                        plan[sale_id]['invoices_cancel'].add(invoice_id)
+                    plan[sale_id]['invoices_ignore'].add(invoice_id)
+        for sale_id, _, move_id in cls.get_pending_moves(sales):
+            plan[sale_id]['moves_ignore'].add(move_id)
+        return {
+            sale_id: {k: sorted(v) if k in keys else v
+                for k, v in actions.items()}
+            for sale_id, actions in plan.items()}
 
     @classmethod
     def validate_moves(cls, sales):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        ShipmentReturn = pool.get('stock.shipment.out.return')
+
+        blockers = cls.get_revoke_blockers(sales, invoices=False)
         for sale in sales:
-            moves = cls._check_moves(sale)
-            picks = [shipment for shipment in
-                list(sale.shipments) + list(sale.shipment_returns)
-                if shipment.state not in ('cancelled', 'waiting', 'draft', 'done')]
-            if moves or picks:
-                names = ', '.join(m.rec_name for m in (moves + picks)[:5])
-                if len(moves + picks) > 5:
-                    names += '...'
-                raise UserError(gettext('sale_revoke.msg_can_not_revoke_moves',
-                    record=sale.rec_name, names=names))
+            if sale.id not in blockers:
+                continue
+            blocker = blockers[sale.id]
+            moves = list(Move.browse(blocker['moves']))
+            picks = (list(Shipment.browse(blocker['shipments']))
+                + list(ShipmentReturn.browse(blocker['shipment_returns'])))
+            names = ', '.join(m.rec_name for m in (moves + picks)[:5])
+            if len(moves + picks) > 5:
+                names += '...'
+            raise UserError(gettext('sale_revoke.msg_can_not_revoke_moves',
+                record=sale.rec_name, names=names))
 
     @classmethod
     def validate_invoices(cls, sales):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        blockers = cls.get_revoke_blockers(sales, moves=False)
         for sale in sales:
-            invalid_invoices = [invoice for invoice in sale.invoices
-                if invoice.state not in ('cancelled', 'draft', 'posted', 'paid')]
-            if invalid_invoices:
-                names = ', '.join(i.rec_name for i in invalid_invoices[:5])
-                if len(invalid_invoices) > 5:
-                    names += '...'
-                raise UserError(gettext('sale_revoke.msg_can_not_revoke_invoices',
+            if sale.id not in blockers:
+                continue
+            invalid_invoices = list(
+                Invoice.browse(blockers[sale.id]['invoices']))
+            names = ', '.join(i.rec_name for i in invalid_invoices[:5])
+            if len(invalid_invoices) > 5:
+                names += '...'
+            raise UserError(gettext('sale_revoke.msg_can_not_revoke_invoices',
                 record=sale.rec_name, names=names))
 
     @classmethod
-    def sale_exception_fix_cron(cls):
+    def _sale_exception_domain(cls, retry=False):
+        "Return the domain of the exception sales to fix of all companies"
         pool = Pool()
-        Sale = pool.get('sale.sale')
         Configuration = pool.get('sale.configuration')
         Date = pool.get('ir.date')
 
-        configuration = Configuration.get_singleton()
-        margin_days = getattr(configuration, 'sale_exception_margin') or 10
-        company = Transaction().context.get('company')
-
-        sales = Sale.search([('company', '=', company),
+        domain = [
             ('state', '=', 'processing'),
-            ('sale_date', '<=', Date.today()
-                - timedelta(days=margin_days)),
             ['OR', ('invoice_state', '=', 'exception'),
-                ('shipment_state', '=', 'exception')]],
-                order=[('sale_date', 'ASC')])
+                ('shipment_state', '=', 'exception')],
+            ]
+        if retry:
+            # The retries of the operator ignore the margin and the backoff
+            return domain
+
+        configuration = Configuration(1)
+        margin_days = configuration.sale_exception_margin or 10
+        max_attempts = configuration.sale_exception_max_attempts
+        today = Date.today()
+
+        domain.extend([
+                ('sale_date', '<=', today - timedelta(days=margin_days)),
+                ['OR', ('exception_retry_date', '=', None),
+                    ('exception_retry_date', '<=', today)],
+                ])
+        if max_attempts:
+            domain.append(('exception_attempts', '<', max_attempts))
+        return domain
+
+    @classmethod
+    def _change_fingerprint_query(cls, sales):
+        "Return a query of the last change date of the records of each sale"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        ShipmentReturn = pool.get('stock.shipment.out.return')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+
+        def last_change(*tables):
+            line = Line.__table__()
+            query = line
+            record, Record = line, Line
+            for Model in tables:
+                table = Model.__table__()
+                if Model in {Move, InvoiceLine}:
+                    condition = table.origin == Concat(
+                        Record.__name__ + ',', record.id)
+                elif Model == Invoice:
+                    condition = record.invoice == table.id
+                else:
+                    condition = record.shipment == Concat(
+                        Model.__name__ + ',', table.id)
+                query = query.join(table, condition=condition)
+                record, Record = table, Model
+            return query.select(
+                line.sale.as_('sale'),
+                Max(Coalesce(record.write_date, record.create_date)).as_(
+                    'date'),
+                where=line.sale.in_(sales),
+                group_by=[line.sale])
+
+        changes = Union(
+            last_change(),
+            last_change(Move),
+            last_change(Move, Move),
+            last_change(Move, Shipment),
+            last_change(Move, ShipmentReturn),
+            last_change(InvoiceLine),
+            last_change(InvoiceLine, Invoice),
+            all_=True)
+        return changes.select(
+            changes.sale.as_('sale'), Max(changes.date).as_('date'),
+            group_by=[changes.sale])
+
+    @classmethod
+    def get_change_fingerprints(cls, sales):
+        "Return the last change date of the records of each sale"
+        sale = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        fingerprints = {}
+        for sub_ids in grouped_slice(
+                [s.id for s in sales], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*cls._change_fingerprint_query(sale.select(sale.id,
+                        where=fields.SQL_OPERATORS['in'](
+                            sale.id, list(sub_ids)))))
+            fingerprints.update(cursor)
+        return fingerprints
+
+    @classmethod
+    def _unchanged_sale_exception_query(
+            cls, company=None, warehouse=None, sale_ids=None):
+        "Return a query of the failed sales not changed since their last fix"
+        sale = cls.__table__()
+        failed = cls.__table__()
+
+        where = ((failed.state == 'processing')
+            & (failed.exception_fingerprint != Null))
+        if company is not None:
+            where &= failed.company == company
+        if warehouse is not None:
+            where &= failed.warehouse == warehouse
+        if sale_ids is not None:
+            where &= fields.SQL_OPERATORS['in'](failed.id, sale_ids)
+        changes = cls._change_fingerprint_query(
+            failed.select(failed.id, where=where))
+        return changes.join(sale, condition=changes.sale == sale.id).select(
+            sale.id, where=changes.date <= sale.exception_fingerprint)
+
+    @classmethod
+    def _unchanged_sale_exceptions(cls, sales):
+        "Return the ids of the failed sales not changed since their last fix"
+        cursor = Transaction().connection.cursor()
+
+        unchanged = set()
+        for sub_ids in grouped_slice(
+                [s.id for s in sales], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*cls._unchanged_sale_exception_query(
+                    sale_ids=list(sub_ids)))
+            unchanged.update(i for i, in cursor)
+        return unchanged
+
+    @classmethod
+    def sale_exception_fix_cron(cls):
+        "Queue a run for each partition of the exception sales to fix"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Run = pool.get('sale.revoke.run')
+        sale = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        configuration = Configuration(1)
+        partition = configuration.sale_exception_partition or 'company'
+        shards = max(configuration.sale_exception_shards or 1, 1)
+        columns = [sale.company]
+        if partition == 'warehouse':
+            columns.append(sale.warehouse)
+        columns.append(sale.id % shards)
+        domain = cls._sale_exception_domain() + [
+            ('id', 'not in', cls._unchanged_sale_exception_query()),
+            ]
+        query = cls.search(domain, query=True)
+        cursor.execute(*sale.select(*columns,
+                where=sale.id.in_(query),
+                group_by=columns, order_by=columns))
+        runs = Run.create([{
+                    'company': row[0],
+                    'warehouse': row[1] if len(row) > 2 else None,
+                    'shard': row[-1] if shards > 1 else None,
+                    'shards': shards if shards > 1 else None,
+                    } for row in cursor])
+        for run in runs:
+            context = {'company': run.company.id}
+            if run.warehouse:
+                context['warehouse'] = run.warehouse.id
+            with transaction.set_context(context):
+                Run.__queue__.enqueue_sales([run])
+
+    @classmethod
+    def _enqueue_sale_exception_partition(cls, run):
+        "Enqueue by batches the exception sales of the partition of the run"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+
+        configuration = Configuration(1)
+        batch_size = configuration.sale_exception_batch_size or 50
+        max_sales = configuration.sale_exception_max_sales
+        warehouse = run.warehouse.id if run.warehouse else None
+        domain = cls._sale_exception_domain() + [
+            ('company', '=', run.company.id),
+            ('id', 'not in', cls._unchanged_sale_exception_query(
+                    company=run.company.id, warehouse=warehouse)),
+            ]
+        if run.warehouse:
+            domain.append(('warehouse', '=', run.warehouse.id))
+        if run.shards:
+            sale = cls.__table__()
+            domain.append(('id', 'in', sale.select(sale.id,
+                        where=(sale.id % run.shards == run.shard)
+                        & (sale.state == 'processing')
+                        & ((sale.invoice_state == 'exception')
+                            | (sale.shipment_state == 'exception')))))
+
+        # The queued sales are skipped by page instead of being sent as
+        # parameters of each query
+        queued = cls._queued_sale_exceptions()
+
+        # Read the sales by pages using the last (sale_date, id) as key so
+        # only one batch is loaded at a time
+        count = 0
+        last = None
+        while max_sales is None or count < max_sales:
+            limit = batch_size
+            if max_sales is not None:
+                limit = min(limit, max_sales - count)
+            page_domain = domain
+            if last:
+                sale_date, sale_id = last
+                page_domain = domain + [['OR',
+                        ('sale_date', '>', sale_date),
+                        [('sale_date', '=', sale_date),
+                            ('id', '>', sale_id)],
+                        ]]
+            sales = cls.search(page_domain,
+                order=[('sale_date', 'ASC'), ('id', 'ASC')], limit=limit)
+            if not sales:
+                break
+            count += len(cls._enqueue_sale_exceptions(sales, run, queued))
+            last = sales[-1].sale_date, sales[-1].id
+        return count
+
+    @classmethod
+    def _schedule_sale_exceptions(cls, sales):
+        "Queue the fix of each sale on its sale date plus the margin"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Date = pool.get('ir.date')
 
+        configuration = Configuration(1)
+        if not configuration.sale_exception_schedule:
+            return
+        margin = timedelta(days=configuration.sale_exception_margin or 10)
+        today = Date.today()
+        now = datetime.now()
+        sales = [s for s in sales if s.state == 'processing']
+        queued = cls._queued_sale_exceptions(sales) if sales else set()
         for sale in sales:
-            cls.__queue__.handle_sale_exception(sale)
+            if sale.id in queued:
+                continue
+            date = (sale.sale_date or today) + margin
+            scheduled_at = datetime.combine(date, datetime.min.time())
+            scheduled_at += timedelta(seconds=sale.id * 7919 % 86400)
+            delay = max(scheduled_at - now, timedelta())
+            with Transaction().set_context(
+                    queue_scheduled_at=delay, queue_expected_at=delay):
+                cls.__queue__.fix_scheduled_exceptions([sale])
 
     @classmethod
-    def handle_sale_exception(cls, sale):
-        sale = cls(sale.id)
+    def fix_scheduled_exceptions(cls, sales):
+        "Fix the exception of the sales which are still to be fixed"
+        cls.handle_sale_exceptions(sales)
+
+    @classmethod
+    def _queued_sale_exceptions(cls, sales=None):
+        "Return the ids of the sales with a pending or running fix task"
+        Queue = Pool().get('ir.queue')
+        queue = Queue.__table__()
+        cursor = Transaction().connection.cursor()
+
+        domain = [
+            ('finished_at', '=', None),
+            ('data.model', '=', cls.__name__),
+            ]
+        if sales is None:
+            domain.append(('data.method', 'in', [
+                        'handle_sale_exceptions',
+                        'handle_sale_exception',
+                        'fix_scheduled_exceptions',
+                        ]))
+        else:
+            # The scheduled fixes have a single instance which can be matched
+            # without reading all the pending tasks
+            domain.extend([
+                    ('data.method', '=', 'fix_scheduled_exceptions'),
+                    ('data.instances', 'in', [[s.id] for s in sales]),
+                    ])
+        with without_check_access():
+            tasks = Queue.search(domain, query=True)
+        cursor.execute(*queue.select(queue.data, where=queue.id.in_(tasks)))
+        sale_ids = set()
+        for data, in cursor:
+            if isinstance(data, str):
+                data = json.loads(data, object_hook=JSONDecoder())
+            instances = data.get('instances')
+            if isinstance(instances, int):
+                sale_ids.add(instances)
+            elif instances:
+                sale_ids.update(instances)
+        if sales is not None:
+            sale_ids &= {s.id for s in sales}
+        return sale_ids
+
+    @classmethod
+    def _enqueue_sale_exceptions(cls, sales, run=None, queued=None):
+        "Enqueue by batches the fix of the sales not already queued"
+        Configuration = Pool().get('sale.configuration')
+
+        if queued is None:
+            queued = cls._queued_sale_exceptions()
+        sales = [s for s in sales if s.id not in queued]
+        batch_size = Configuration(1).sale_exception_batch_size or 50
+        run_id = run.id if run else None
+        for i in range(0, len(sales), batch_size):
+            cls.__queue__.handle_sale_exceptions(
+                sales[i:i + batch_size], run_id)
+        queued.update(s.id for s in sales)
+        return sales
+
+    @classmethod
+    def handle_sale_exceptions(cls, sales, run=None, retry=False):
+        "Fix the exception of the sales and return the errors of each sale"
+        pool = Pool()
+        Run = pool.get('sale.revoke.run')
+        RunLine = pool.get('sale.revoke.run.line')
+
+        retry = retry or (run is not None and bool(Run(run).origin))
+        sales = cls._revoke_browse(sales)
+        skipped, contended = cls.lock_revoke(sales)
+        if skipped:
+            logger.info("Skipped sales claimed by another worker: %s",
+                skipped)
+        if contended:
+            logger.info("Deferred locked sales: %s", contended)
+            with Transaction().set_context(
+                    queue_scheduled_at=LOCK_RETRY_DELAY):
+                cls.__queue__.handle_sale_exceptions(contended, run)
+        skipped = set(skipped) | set(contended)
+        sales = [s for s in sales if s.id not in skipped]
+        # The sales may have been fixed or changed since they were queued
+        unchanged = set() if retry else cls._unchanged_sale_exceptions(sales)
+        ids = [s.id for s in sales if s.id not in unchanged]
+        if ids:
+            ids = {s.id for s in cls.search([('id', 'in', ids)]
+                    + cls._sale_exception_domain(retry=retry))}
+        sales = [s for s in sales if s.id in ids]
+        all_sales = sales
+        errors = {}
+        with revoke_phases('exception') as phases:
+            for step, method in [
+                    ('process', cls.process_states),
+                    ('validation', cls._validate_sale_exceptions),
+                    ('shipment', cls.handle_shipments),
+                    ('invoice', cls.handle_invoices),
+                    ]:
+                sales = [s for s in sales if s.id not in errors]
+                for sale_id, error in cls._run_isolated(
+                        method, sales, step).items():
+                    logger.warning("Skipped %s: %s, Error: %s",
+                        step, sale_id, error)
+                    errors[sale_id] = (step, error)
+        cls._update_exception_attempts(all_sales, errors, retry=retry)
+        if run is not None:
+            RunLine.store(run, all_sales, errors, phases)
+        return errors
+
+    @classmethod
+    def _update_exception_attempts(cls, sales, errors, retry=False):
+        "Delay the next fix of the failed sales and reset the fixed ones"
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        fingerprints = cls.get_change_fingerprints(
+            [s for s in sales if s.id in errors])
+        to_write = []
+        to_reset = []
+        for sale in sales:
+            if sale.id in errors:
+                step, _ = errors[sale.id]
+                values = {
+                    'exception_failure': step,
+                    'exception_fingerprint': fingerprints.get(sale.id),
+                    }
+                # The retries of the operator do not delay the cron
+                if not retry:
+                    attempts = (sale.exception_attempts or 0) + 1
+                    values['exception_attempts'] = attempts
+                    values['exception_retry_date'] = today + timedelta(
+                        days=min(2 ** (attempts - 1), MAX_RETRY_DAYS))
+                to_write.extend(([sale], values))
+            elif (sale.exception_attempts or sale.exception_failure
+                    or sale.exception_fingerprint):
+                to_reset.append(sale)
+        if to_reset:
+            to_write.extend((to_reset, {
+                        'exception_attempts': 0,
+                        'exception_failure': None,
+                        'exception_retry_date': None,
+                        'exception_fingerprint': None,
+                        }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    @ModelView.button
+    def reset_exception_attempts(cls, sales):
+        "Let the parked sales be fixed again by the cron"
+        cls.write(sales, {
+                'exception_attempts': 0,
+                'exception_failure': None,
+                'exception_retry_date': None,
+                'exception_fingerprint': None,
+                })
 
+    @classmethod
+    def _run_isolated(cls, method, sales, phase):
+        "Run method on the sales and return the error of the failing sales"
+        errors = {}
+        if not sales:
+            return errors
         try:
-            sale.process([sale])
+            with savepoint('sale_revoke'), revoke_phase(phase, sales):
+                method(sales)
         except TransactionError:
             raise
         except Exception as e:
-            logger.warning("Skipped process: "+str(sale.id)+", Error: "+str(e))
-            return
+            if len(sales) == 1:
+                sale, = sales
+                errors[sale.id] = e
+            else:
+                for sale in sales:
+                    errors.update(
+                        cls._run_isolated(method, [sale], phase))
+        return errors
+
+    @classmethod
+    def _validate_sale_exceptions(cls, sales):
+        blockers = cls.get_revoke_blockers(sales)
+        cls.validate_moves([s for s in sales if s.id in blockers])
+        cls.validate_invoices([s for s in sales if s.id in blockers])
+
+    @classmethod
+    def plan_sale_exceptions(cls, sales):
+        "Return the plan of the fix of the exception of the sales"
+        return cls.get_revoke_plan(sales)
+
+    @classmethod
+    @ModelView.button_action('sale_revoke.wizard_fix_exception')
+    def fix_exception(cls, sales):
+        pass
 
-        sale.validate_moves([sale])
-        sale.validate_invoices([sale])
+    @classmethod
+    def handle_sale_exception(cls, sale):
+        cls.handle_sale_exceptions([sale])
 
+    @classmethod
+    def revoke_sales(cls, sales, manage_invoices=False):
+        "Revoke the sales from a queued task"
+        ids = [s.id for s in sales]
         try:
-            sale.handle_shipments([sale])
-        except TransactionError:
+            with savepoint('sale_revoke_sales'), revoke_phases('revoke'):
+                sales = cls._revoke_browse(ids)
+                skipped, contended = cls.lock_revoke(sales)
+                if skipped:
+                    logger.info("Skipped sales claimed by another worker: %s",
+                        skipped)
+                if contended:
+                    logger.info("Deferred locked sales: %s", contended)
+                    with Transaction().set_context(
+                            queue_scheduled_at=LOCK_RETRY_DELAY):
+                        cls.__queue__.revoke_sales(contended, manage_invoices)
+                skipped = set(skipped) | set(contended)
+                sales = [s for s in sales if s.id not in skipped]
+                steps = [('validate_moves', cls.validate_moves)]
+                if manage_invoices:
+                    steps.extend([
+                            ('validate_invoices', cls.validate_invoices),
+                            ('invoice', cls.handle_invoices),
+                            ])
+                steps.append(('shipment', cls.handle_shipments))
+                errors = {}
+                for phase, method in steps:
+                    sales = [s for s in sales if s.id not in errors]
+                    errors.update(cls._run_isolated(method, sales, phase))
+                for sale_id, error in errors.items():
+                    logger.warning(
+                        "Revoke failed: %s, Error: %s", sale_id, error)
+                to_write = []
+                if sales:
+                    to_write.extend((sales, {'revoke_state': 'done'}))
+                if errors:
+                    to_write.extend((cls.browse(errors.keys()),
+                            {'revoke_state': 'failed'}))
+                if to_write:
+                    cls.write(*to_write)
+        except (TransactionError, backend.DatabaseOperationalError):
             raise
-        except Exception as e:
-            logger.warning("Skipped shipment: "+str(sale.id)+", Error: "+str(e))
-            return
+        except Exception:
+            logger.exception("Revoke failed: %s", ids)
+            cls.write(cls.browse(ids), {'revoke_state': 'failed'})
+
+    @classmethod
+    def lock_revoke(cls, sales, nowait=True):
+        "Lock the sales records and return the skipped and contended sale ids"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        ShipmentReturn = pool.get('stock.shipment.out.return')
+        line = Line.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
 
+        models = {m.__name__: m for m in [cls, Move, Shipment, ShipmentReturn]}
+        records = {s.id: defaultdict(set, {cls.__name__: {s.id}})
+            for s in sales}
+        for sub_ids in grouped_slice(list(records), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(move,
+                    condition=move.origin == Concat(
+                        Line.__name__ + ',', line.id)
+                    ).select(line.sale, move.id, move.shipment,
+                    where=fields.SQL_OPERATORS['in'](
+                        line.sale, list(sub_ids))))
+            for sale_id, move_id, shipment in cursor:
+                records[sale_id][Move.__name__].add(move_id)
+                if shipment:
+                    model, shipment_id = shipment.split(',')
+                    if model in models:
+                        records[sale_id][model].add(int(shipment_id))
+
+        def lock(sale_ids):
+            ids = defaultdict(set)
+            for sale_id in sale_ids:
+                for model, model_ids in records[sale_id].items():
+                    ids[model].update(model_ids)
+            # Lock by table and ascending id so concurrent revokes always
+            # lock the rows in the same order
+            tables = sorted(ids, key=lambda m: models[m]._table)
+            if database.has_select_for():
+                for model in tables:
+                    table = models[model].__table__()
+                    for sub_ids in grouped_slice(
+                            sorted(ids[model]), backend.MAX_QUERY_PARAMS):
+                        cursor.execute(*table.select(table.id,
+                                where=fields.SQL_OPERATORS['in'](
+                                    table.id, list(sub_ids)),
+                                order_by=[table.id.asc],
+                                for_=For('UPDATE', nowait=nowait)))
+            # Model.lock restarts the transaction with the sales locked
+            # unless it already started with them
+            cls.lock(cls.browse(sorted(ids[cls.__name__])))
+
+        # Claim the sales with advisory locks so no other worker handles them
+        claimed = sorted(records)
+        if database.has_select_for():
+            claimed = []
+            for sub_ids in grouped_slice(sorted(records), 1000):
+                sub_ids = list(sub_ids)
+                cursor.execute(*Select([
+                            database.lock_id(
+                                str2bigint('%s,%s' % (cls.__name__, i)),
+                                not nowait)
+                            for i in sub_ids]))
+                locked = cursor.fetchone()
+                claimed.extend(i for i, l in zip(sub_ids, locked)
+                    if not nowait or l)
+        # Another worker is already handling the sales it claimed so only the
+        # sales with rows locked by another transaction are retried
+        skipped = sorted(set(records) - set(claimed))
+
+        if not nowait or not database.has_select_for():
+            lock(claimed)
+            return skipped, []
         try:
-            sale.handle_invoices([sale])
-        except TransactionError:
-            raise
-        except Exception as e:
-            logger.warning("Skipped invoice: "+str(sale.id)+", Error: "+str(e))
-            return
+            with savepoint('sale_revoke_lock'):
+                lock(claimed)
+            return skipped, []
+        except backend.DatabaseOperationalError:
+            pass
+        contended = []
+        for sale_id in claimed:
+            try:
+                with savepoint('sale_revoke_lock'):
+                    lock([sale_id])
+            except backend.DatabaseOperationalError:
+                contended.append(sale_id)
+        return skipped, contended
+
+    @classmethod
+    def _revoke_browse(cls, sales):
+        "Browse the sales with a cache large enough for their lines and moves"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        line = Line.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        ids = [int(s) for s in sales]
+        lines = moves = 0
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(move, 'LEFT',
+                    condition=move.origin == Concat(
+                        Line.__name__ + ',', line.id)
+                    ).select(
+                    Count(line.id, distinct=True), Count(move.id),
+                    where=fields.SQL_OPERATORS['in'](
+                        line.sale, list(sub_ids))))
+            sub_lines, sub_moves = cursor.fetchone()
+            lines += sub_lines or 0
+            moves += sub_moves or 0
+        size = max(len(ids), lines, moves, record_cache_size(transaction))
+        with transaction.set_context(_record_cache_size=size):
+            return cls.browse(ids)
+
+    @classmethod
+    def get_pending_moves(cls, sales):
+        "Return the cancelled moves of the sales to ignore"
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        LineIgnoredMove = pool.get('sale.line-ignored-stock.move')
+        LineRecreatedMove = pool.get('sale.line-recreated-stock.move')
+        line = Line.__table__()
+        move = Move.__table__()
+        ignored = LineIgnoredMove.__table__()
+        recreated = LineRecreatedMove.__table__()
+        cursor = Transaction().connection.cursor()
+
+        pending_moves = []
+        for sub_ids in grouped_slice(
+                [s.id for s in sales], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line
+                .join(move,
+                    condition=move.origin == Concat(
+                        Line.__name__ + ',', line.id))
+                .join(ignored, 'LEFT',
+                    condition=(ignored.sale_line == line.id)
+                    & (ignored.move == move.id))
+                .join(recreated, 'LEFT',
+                    condition=(recreated.sale_line == line.id)
+                    & (recreated.move == move.id))
+                .select(line.sale, line.id, move.id,
+                    where=fields.SQL_OPERATORS['in'](
+                        line.sale, list(sub_ids))
+                    & (move.state == 'cancelled')
+                    & (ignored.id == Null)
+                    & (recreated.id == Null),
+                    order_by=[line.id, move.id]))
+            pending_moves.extend(cursor)
+        return pending_moves
 
     @classmethod
     def handle_shipments(cls, sales):
         pool = Pool()
         Shipment = pool.get('stock.shipment.out')
         ShipmentReturn = pool.get('stock.shipment.out.return')
-        HandleShipmentException = pool.get(
-            'sale.handle.shipment.exception', type='wizard')
+        Line = pool.get('sale.line')
 
-        for sale in sales:
-            sale = cls(sale.id)
-            Shipment.draft([shipment for shipment in sale.shipments
-                if shipment.state == 'waiting'])
-            Shipment.cancel([shipment for shipment in sale.shipments
-                if shipment.state == 'draft'])
-            ShipmentReturn.cancel([shipment for shipment in sale.shipment_returns
-                if shipment.state == 'draft'])
-
-            moves = [move for line in sale.lines for move in line.moves
-                if move.state == 'cancelled']
-            skip = set()
-            for line in sale.lines:
-                skip |= set(line.moves_ignored + line.moves_recreated)
-            pending_moves = [x for x in moves if not x in skip]
-
-            with Transaction().set_context(active_model=cls.__name__,
-                    active_ids=[sale.id], active_id=sale.id):
-                session_id, _, _ = HandleShipmentException.create()
-                handle_shipment_exception = HandleShipmentException(session_id)
-                handle_shipment_exception.ask.recreate_moves = []
-                handle_shipment_exception.ask.ignore_moves = pending_moves
-                handle_shipment_exception.ask.domain_moves = pending_moves
-                handle_shipment_exception.transition_handle()
-                HandleShipmentException.delete(session_id)
+        sales = cls._revoke_browse(sales)
+        shipments = {s for sale in sales for s in sale.shipments}
+        with revoke_phase('shipment.draft', sales) as phase:
+            to_draft = [s for s in shipments if s.state == 'waiting']
+            Shipment.draft(to_draft)
+            phase['records'] = len(to_draft)
+        with revoke_phase('shipment.cancel', sales) as phase:
+            to_cancel = [s for s in shipments if s.state == 'draft']
+            Shipment.cancel(to_cancel)
+            returns = {s for sale in sales for s in sale.shipment_returns}
+            returns = [s for s in returns if s.state == 'draft']
+            ShipmentReturn.cancel(returns)
+            phase['records'] = len(to_cancel) + len(returns)
+
+        # Ignore the cancelled moves as the handle shipment exception wizard
+        # does but for all the sales at once
+        with revoke_phase('shipment.ignore', sales) as phase:
+            pending_moves = cls.get_pending_moves(sales)
+            line_moves = defaultdict(list)
+            for _, line_id, move_id in pending_moves:
+                line_moves[line_id].append(move_id)
+            to_write = []
+            for line_id, move_ids in line_moves.items():
+                to_write.extend(([Line(line_id)], {
+                            'moves_ignored': [('add', move_ids)],
+                            }))
+            if to_write:
+                Line.write(*to_write)
+            phase['records'] = len(pending_moves)
+        with revoke_phase('shipment.process', sales):
+            cls.process_states(sales)
 
     @classmethod
     def handle_invoices(cls, sales):
         pool = Pool()
         Invoice = pool.get('account.invoice')
-        HandleInvoiceException = pool.get(
-            'sale.handle.invoice.exception', type='wizard')
 
-        for sale in sales:
-            sale = cls(sale.id)
-            Invoice.cancel([invoice for invoice in sale.invoices
-                if invoice.state == 'draft'])
-
-            cancel_invoices = [invoice for invoice in sale.invoices
-                if invoice.state == 'cancelled']
-            skip = set(sale.invoices_ignored + sale.invoices_recreated)
-            pending_invoices = [i for i in cancel_invoices if not i in skip]
-
-            with Transaction().set_context(active_model=cls.__name__,
-                    active_ids=[sale.id], active_id=sale.id):
-                session_id, _, _ = HandleInvoiceException.create()
-                handle_invoice_exception = HandleInvoiceException(session_id)
-                handle_invoice_exception.ask.recreate_invoices = []
-                handle_invoice_exception.ask.ignore_invoices = pending_invoices
-                handle_invoice_exception.ask.domain_invoices = pending_invoices
-                handle_invoice_exception.transition_handle()
-                HandleInvoiceException.delete(session_id)
+        sales = cls._revoke_browse(sales)
+        with revoke_phase('invoice.cancel', sales) as phase:
+            invoices = {i for sale in sales for i in sale.invoices}
+            to_cancel = [i for i in invoices if i.state == 'draft']
+            Invoice.cancel(to_cancel)
+            phase['records'] = len(to_cancel)
+
+        # Ignore the cancelled invoices as the handle invoice exception wizard
+        # does but for all the sales at once
+        with revoke_phase('invoice.ignore', sales) as phase:
+            to_write = []
+            for sale in sales:
+                skip = set(sale.invoices_ignored + sale.invoices_recreated)
+                invoices = [i.id for i in sale.invoices
+                    if i.state == 'cancelled' and i not in skip]
+                if invoices:
+                    to_write.extend(([sale], {
+                                'invoices_ignored': [('add', invoices)],
+                                }))
+            if to_write:
+                cls.write(*to_write)
+            phase['records'] = len(to_write) // 2
+        with revoke_phase('invoice.process', sales):
+            cls.process_states(sales)
+
+    @classmethod
+    def process_states(cls, sales):
+        "Process only the sales with documents to create or a state to change"
+        states = {'confirmed', 'processing', 'done'}
+        sales = [s for s in cls._revoke_browse(sales) if s.state in states]
+        cls.lock(sales)
+        cls._process_invoice_fulfillment_states(sales)
+        # Go through process so the extensions of the other modules still run
+        to_process = [s for s in sales
+            if (s.to_ship and s.shipment_method != 'manual')
+            or (s.to_invoice and s.invoice_method != 'manual')
+            or (s.state != 'done' if s.is_done()
+                else s.state != 'processing')]
+        if to_process:
+            cls.process(to_process)
 
     @classmethod
     @ModelView.button_action('sale_revoke.act_sale_create_pending_moves_wizard')
@@ -231,11 +1361,143 @@ class Sale(metaclass=PoolMeta):
         pass
 
 
+def _update_revocation_status(lines):
+    "Update the revocation status of the sales of the sale lines"
+    pool = Pool()
+    Line = pool.get('sale.line')
+    Sale = pool.get('sale.sale')
+
+    Sale.update_revocation_status(
+        {l.sale for l in lines if isinstance(l, Line)})
+
+
+def _move_sale_lines(moves):
+    "Return the origins of the moves and of the moves they are created from"
+    Move = Pool().get('stock.move')
+    origins = []
+    for move in moves:
+        origin = move.origin
+        # The inventory moves of the shipments come from their outgoing moves
+        # and the inventory moves of the returns from their incoming moves
+        if isinstance(origin, Move):
+            origin = origin.origin
+        origins.append(origin)
+    return origins
+
+
+class SaleLineIgnoredMove(metaclass=PoolMeta):
+    __name__ = 'sale.line-ignored-stock.move'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        if mode == 'create':
+            _update_revocation_status([r.sale_line for r in records])
+
+    @classmethod
+    def on_delete(cls, records):
+        lines = [r.sale_line for r in records]
+        return super().on_delete(records) + [
+            lambda: _update_revocation_status(lines)]
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        super().on_modification(mode, moves, field_names=field_names)
+        if mode == 'create' or 'state' in (field_names or {'state'}):
+            _update_revocation_status(_move_sale_lines(moves))
+
+    @classmethod
+    def on_delete(cls, moves):
+        lines = _move_sale_lines(moves)
+        return super().on_delete(moves) + [
+            lambda: _update_revocation_status(lines)]
+
+
+class ShipmentOut(metaclass=PoolMeta):
+    __name__ = 'stock.shipment.out'
+
+    @classmethod
+    def on_modification(cls, mode, shipments, field_names=None):
+        super().on_modification(mode, shipments, field_names=field_names)
+        if mode == 'write' and 'state' in (field_names or {'state'}):
+            _update_revocation_status(
+                [m.origin for s in shipments for m in s.moves])
+
+
+class ShipmentOutReturn(metaclass=PoolMeta):
+    __name__ = 'stock.shipment.out.return'
+
+    @classmethod
+    def on_modification(cls, mode, shipments, field_names=None):
+        super().on_modification(mode, shipments, field_names=field_names)
+        if mode == 'write' and 'state' in (field_names or {'state'}):
+            _update_revocation_status(
+                [m.origin for s in shipments for m in s.moves])
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def on_modification(cls, mode, invoices, field_names=None):
+        super().on_modification(mode, invoices, field_names=field_names)
+        if mode == 'write' and 'state' in (field_names or {'state'}):
+            _update_revocation_status(
+                [l.origin for i in invoices for l in i.lines])
+
+
 class SaleRevokeStart(ModelView):
     'Revoke Start'
     __name__ = 'sale.sale.revoke.start'
 
     manage_invoices = fields.Boolean('Also Manage Invoices?')
+    queued = fields.Boolean('Run in Background',
+        help='Revoke the sales from the queue and follow the progress on '
+        'their revoke state.')
+
+
+class SaleRevokePlan(ModelView):
+    'Revoke Plan'
+    __name__ = 'sale.sale.revoke.plan'
+
+    sales = fields.Integer('Sales', readonly=True)
+    blocked = fields.Integer('Blocked Sales', readonly=True)
+    shipments_draft = fields.Integer('Shipments to Draft', readonly=True)
+    shipments_cancel = fields.Integer('Shipments to Cancel', readonly=True)
+    shipment_returns_cancel = fields.Integer('Shipment Returns to Cancel',
+        readonly=True)
+    invoices_cancel = fields.Integer('Invoices to Cancel', readonly=True)
+    moves_ignore = fields.Integer('Moves to Ignore', readonly=True)
+    invoices_ignore = fields.Integer('Invoices to Ignore', readonly=True)
+    details = fields.Text('Details', readonly=True)
+
+    @classmethod
+    def get_values(cls, sales, plan, invoices=True):
+        "Return the values of the plan of the sales"
+        keys = ['shipments_draft', 'shipments_cancel',
+            'shipment_returns_cancel', 'invoices_cancel', 'moves_ignore',
+            'invoices_ignore']
+        if not invoices:
+            keys = [k for k in keys if not k.startswith('invoices_')]
+        values = {k: sum(len(p[k]) for p in plan.values()) for k in keys}
+        values['sales'] = len(sales)
+        values['blocked'] = sum(p['blocked'] for p in plan.values())
+        details = []
+        for sale in sales:
+            actions = plan[sale.id]
+            if actions['blocked']:
+                details.append('%s: blocked' % sale.rec_name)
+            else:
+                details.append('%s: %s' % (sale.rec_name, ', '.join(
+                            '%s: %s' % (cls._fields[k].string,
+                                len(actions[k]))
+                            for k in keys)))
+        values['details'] = '\n'.join(details)
+        return values
 
 
 class SaleRevoke(Wizard):
@@ -245,79 +1507,359 @@ class SaleRevoke(Wizard):
     start = StateView('sale.sale.revoke.start',
         'sale_revoke.sale_revoke_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Plan', 'plan', 'tryton-search'),
+            Button('Revoke', 'revoke', 'tryton-ok', default=True),
+            ])
+    plan = StateView('sale.sale.revoke.plan',
+        'sale_revoke.sale_revoke_plan_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Back', 'start', 'tryton-back'),
             Button('Revoke', 'revoke', 'tryton-ok', default=True),
             ])
 
     revoke = StateTransition()
 
+    def default_plan(self, fields):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Plan = pool.get('sale.sale.revoke.plan')
+
+        invoices = bool(self.start.manage_invoices)
+        sales = Sale._revoke_browse(self.records)
+        plan = Sale.get_revoke_plan(sales, invoices=invoices)
+        return Plan.get_values(sales, plan, invoices=invoices)
+
     def transition_revoke(self):
         Sale = Pool().get('sale.sale')
 
-        Sale.validate_moves(self.records)
-        if self.start.manage_invoices:
-            Sale.validate_invoices(self.records)
-            Sale.handle_invoices(self.records)
-        Sale.handle_shipments(self.records)
+        sales = self.records
+        with revoke_phases('revoke'):
+            if not self.start.queued:
+                Sale.lock_revoke(sales, nowait=False)
+            with revoke_phase('validate_moves', sales):
+                Sale.validate_moves(sales)
+            if self.start.manage_invoices:
+                with revoke_phase('validate_invoices', sales):
+                    Sale.validate_invoices(sales)
+            if self.start.queued:
+                Sale.write(list(sales), {'revoke_state': 'queued'})
+                with Transaction().set_context(queue_batch=True):
+                    Sale.__queue__.revoke_sales(
+                        sales, self.start.manage_invoices)
+                return 'end'
+            if self.start.manage_invoices:
+                with revoke_phase('invoice', sales):
+                    Sale.handle_invoices(sales)
+            with revoke_phase('shipment', sales):
+                Sale.handle_shipments(sales)
+
+        return 'end'
+
+
+class SaleFixException(Wizard):
+    'Fix Sale Exception'
+    __name__ = 'sale.sale.fix_exception'
+
+    start = StateView('sale.sale.revoke.plan',
+        'sale_revoke.sale_revoke_plan_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Fix', 'fix', 'tryton-ok', default=True),
+            ])
+    fix = StateTransition()
+
+    def default_start(self, fields):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Plan = pool.get('sale.sale.revoke.plan')
 
+        sales = Sale._revoke_browse(self.records)
+        return Plan.get_values(sales, Sale.plan_sale_exceptions(sales))
+
+    def transition_fix(self):
+        Sale = Pool().get('sale.sale')
+        Sale.handle_sale_exceptions(self.records, retry=True)
         return 'end'
 
 
+class SaleCreatePendingMovesStart(ModelView):
+    'Create Pending Moves Start'
+    __name__ = 'sale.sale.create_pending_moves.start'
+
+    only_pending_lines = fields.Boolean('Only Pending Lines',
+        help='Copy only the lines with ignored moves.')
+
+
 class SaleCreatePendingMoves(Wizard):
     "Sale Create Pending Moves"
     __name__ = 'sale.sale.create_pending_moves'
-    start = StateAction('sale.act_sale_form')
 
-    def do_start(self, action):
+    start = StateView('sale.sale.create_pending_moves.start',
+        'sale_revoke.sale_create_pending_moves_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_', 'tryton-ok', default=True),
+            ])
+    create_ = StateAction('sale.act_sale_form')
+
+    def default_start(self, fields):
+        Configuration = Pool().get('sale.configuration')
+
+        configuration = Configuration(1)
+        return {
+            'only_pending_lines': bool(
+                configuration.sale_pending_moves_only_pending_lines),
+            }
+
+    def do_create_(self, action):
         pool = Pool()
         Uom = pool.get('product.uom')
         Sale = pool.get('sale.sale')
         Line = pool.get('sale.line')
 
-        new_sales = []
-        for sale in self.records:
-            ignored_moves = sale.ignored_moves
-            if not ignored_moves:
-                continue
-
-            products = dict((move.product.id, 0) for move in ignored_moves)
-            sale_units = dict((move.product.id, move.product.sale_uom)
-                for move in ignored_moves)
+        sales = [s for s in self.records if s.ignored_moves]
 
-            for move in ignored_moves:
+        # Sum the ignored quantities per sale and product in the sale unit
+        quantities = defaultdict(lambda: defaultdict(float))
+        sale_units = defaultdict(dict)
+        factors = {}
+        for sale in sales:
+            for move in sale.ignored_moves:
+                product = move.product
                 from_uom = move.unit
-                to_uom = move.product.sale_uom
+                to_uom = product.sale_uom
                 if from_uom != to_uom:
-                    qty = Uom.compute_qty(from_uom, move.quantity,
-                        to_uom, round=False)
+                    key = (from_uom.id, to_uom.id)
+                    if key not in factors:
+                        factors[key] = Uom.compute_qty(
+                            from_uom, 1, to_uom, round=False)
+                    qty = move.quantity * factors[key]
                 else:
                     qty = move.quantity
-                products[move.product.id] += qty
-
-            new_sale, = Sale.copy([sale], {'lines': []})
-
-            def default_quantity(data):
-                product_id = data.get('product')
-                quantity = data.get('quantity')
-                if product_id and products.get(product_id):
-                    return products[product_id]
-                return quantity
-
-            def default_sale_unit(data):
-                product_id = data.get('product')
-                unit_id = data.get('unit')
-                if product_id and sale_units.get(product_id):
-                    return sale_units[product_id]
-                return unit_id
-
-            Line.copy(sale.lines, default={
-                'sale': new_sale,
-                'quantity': default_quantity,
-                'unit': default_sale_unit,
-                })
+                quantities[sale.id][product.id] += qty
+                sale_units[sale.id][product.id] = to_uom.id
+
+        new_sales = Sale.copy(sales, {'lines': []})
+        sale2new = {s.id: n.id for s, n in zip(sales, new_sales)}
+
+        def default_sale(data):
+            return sale2new[data['sale']]
+
+        def default_quantity(data):
+            product_id = data.get('product')
+            quantity = data.get('quantity')
+            products = quantities[data['sale']]
+            if product_id and products.get(product_id):
+                return products[product_id]
+            return quantity
+
+        def default_sale_unit(data):
+            product_id = data.get('product')
+            unit_id = data.get('unit')
+            units = sale_units[data['sale']]
+            if product_id and units.get(product_id):
+                return units[product_id]
+            return unit_id
 
-            new_sales.append(new_sale)
+        lines = [l for s in sales for l in s.lines]
+        if self.start.only_pending_lines:
+            lines = [l for l in lines
+                if l.product and l.product.id in quantities[l.sale.id]]
+        Line.copy(lines, default={
+            'sale': default_sale,
+            'quantity': default_quantity,
+            'unit': default_sale_unit,
+            })
 
         data = {'res_id': [s.id for s in new_sales]}
         if len(new_sales) == 1:
             action['views'].reverse()
         return action, data
+
+
+class SaleRevokeLog(ModelSQL, ModelView):
+    'Sale Revoke Log'
+    __name__ = 'sale.revoke.log'
+
+    operation = fields.Selection([
+            ('revoke', 'Revoke'),
+            ('exception', 'Exception Fix'),
+            ], 'Operation', readonly=True)
+    phase = fields.Char('Phase', readonly=True)
+    sale = fields.Many2One('sale.sale', 'Sale', readonly=True,
+        ondelete='CASCADE',
+        help='The sale when the phase is run for a single sale.')
+    sales = fields.Integer('Sales', readonly=True)
+    records = fields.Integer('Records Touched', readonly=True)
+    queries = fields.Integer('Queries', readonly=True,
+        help='Empty when the database backend does not log the queries.')
+    duration = fields.Float('Duration (s)', digits=(12, 3), readonly=True)
+    failed = fields.Boolean('Failed', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    @without_check_access
+    def store(cls, operation, phases):
+        "Store the phases of the operation if enabled in the configuration"
+        Configuration = Pool().get('sale.configuration')
+
+        if not phases or not Configuration(1).sale_revoke_log:
+            return []
+        names = ['phase', 'sale', 'sales', 'records', 'queries',
+            'duration', 'failed']
+        return cls.create([
+                dict({n: p[n] for n in names}, operation=operation)
+                for p in phases])
+
+
+class SaleRevokeRun(ModelSQL, ModelView):
+    'Sale Revoke Run'
+    __name__ = 'sale.revoke.run'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    warehouse = fields.Many2One('stock.location', 'Warehouse', readonly=True,
+        domain=[('type', '=', 'warehouse')])
+    shard = fields.Integer('Shard', readonly=True,
+        states={
+            'invisible': ~Eval('shards'),
+            },
+        help='The remainder of the sale ids divided by the shards.')
+    shards = fields.Integer('Shards', readonly=True,
+        states={
+            'invisible': ~Eval('shards'),
+            })
+    origin = fields.Many2One('sale.revoke.run', 'Retry of', readonly=True,
+        ondelete='SET NULL')
+    lines = fields.One2Many('sale.revoke.run.line', 'run', 'Lines',
+        readonly=True)
+    sales = fields.Function(fields.Integer('Sales'), 'get_stats')
+    fixed = fields.Function(fields.Integer('Fixed'), 'get_stats')
+    failed = fields.Function(fields.Integer('Failed'), 'get_stats')
+    failure_rate = fields.Function(fields.Float('Failure Rate',
+            digits=(1, 4)), 'get_stats')
+    duration = fields.Function(fields.Float('Duration (s)', digits=(12, 3)),
+        'get_stats')
+    throughput = fields.Function(fields.Float('Throughput (sales/s)',
+            digits=(12, 2)), 'get_stats')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': ~Eval('failed', 0),
+                    'depends': ['failed'],
+                    },
+                })
+
+    @classmethod
+    def get_stats(cls, runs, names):
+        pool = Pool()
+        RunLine = pool.get('sale.revoke.run.line')
+        line = RunLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {n: {r.id: None for r in runs} for n in names}
+        for name in {'sales', 'fixed', 'failed'} & set(names):
+            result[name] = {r.id: 0 for r in runs}
+        cursor.execute(*line.select(
+                line.run,
+                Count(line.id),
+                Sum(Case((line.outcome == 'fixed', 1), else_=0)),
+                Sum(line.duration),
+                where=fields.SQL_OPERATORS['in'](
+                    line.run, [r.id for r in runs]),
+                group_by=[line.run]))
+        for run_id, count, fixed, duration in cursor:
+            values = {
+                'sales': count,
+                'fixed': fixed,
+                'failed': count - fixed,
+                'failure_rate': (count - fixed) / count,
+                'duration': duration,
+                'throughput': count / duration if duration else None,
+                }
+            for name in names:
+                result[name][run_id] = values[name]
+        return result
+
+    @classmethod
+    def enqueue_sales(cls, runs):
+        "Enqueue the exception sales of the partition of the runs"
+        Sale = Pool().get('sale.sale')
+
+        # The runs whose sales are all already queued have nothing to report
+        cls.delete([r for r in runs
+                if not Sale._enqueue_sale_exception_partition(r)])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, runs):
+        "Enqueue the fix of the sales that failed on the runs"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        for run in runs:
+            sale_ids = [l.sale.id for l in run.lines if l.outcome != 'fixed']
+            sales = Sale.search([
+                    ('id', 'in', sale_ids),
+                    ] + Sale._sale_exception_domain(retry=True),
+                order=[('sale_date', 'ASC'), ('id', 'ASC')])
+            if not sales:
+                continue
+            new_run, = cls.create([{
+                        'company': run.company.id if run.company else None,
+                        'warehouse': (
+                            run.warehouse.id if run.warehouse else None),
+                        'origin': run.id,
+                        }])
+            Sale._enqueue_sale_exceptions(sales, new_run)
+
+
+class SaleRevokeRunLine(ModelSQL, ModelView):
+    'Sale Revoke Run Line'
+    __name__ = 'sale.revoke.run.line'
+
+    run = fields.Many2One('sale.revoke.run', 'Run', required=True,
+        readonly=True, ondelete='CASCADE')
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, readonly=True,
+        ondelete='CASCADE')
+    outcome = fields.Selection([
+            ('fixed', 'Fixed'),
+            ('process', 'Skipped at Process'),
+            ('validation', 'Blocked by Validation'),
+            ('shipment', 'Skipped at Shipment'),
+            ('invoice', 'Skipped at Invoice'),
+            ], 'Outcome', readonly=True)
+    message = fields.Text('Message', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(12, 3), readonly=True,
+        help='The share of the batch duration spent on the sale.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('duration', 'DESC'))
+
+    @classmethod
+    def store(cls, run_id, sales, errors, phases):
+        "Store in bulk the outcome of the sales of a batch of the run"
+        durations = defaultdict(float)
+        for phase in phases:
+            if '.' in phase['phase']:
+                continue
+            for sale_id in phase['sale_ids']:
+                durations[sale_id] += phase['duration'] / phase['sales']
+        to_create = []
+        for sale in sales:
+            step, error = errors.get(sale.id, ('fixed', None))
+            to_create.append({
+                    'run': run_id,
+                    'sale': sale.id,
+                    'outcome': step,
+                    'message': str(error) if error is not None else None,
+                    'duration': round(durations[sale.id], 3),
+                    })
+        return cls.create(to_create)
@@ -0,0 +1,292 @@
+import datetime as dt
+import logging
+import os
+import time
+import unittest
+from contextlib import contextmanager
+from decimal import Decimal
+
+from proteus import Model, Wizard
+from trytond.modules.account.tests.tools import (create_chart,
+                                                 create_fiscalyear, create_tax,
+                                                 get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.sale_revoke.sale import BACKEND_LOGGERS, QueryCounter
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+# The benchmark is only run when SALE_REVOKE_BENCHMARK is set, the size of
+# the fixtures is set with:
+#   SALE_REVOKE_BENCHMARK_SALES: number of sales of each group (N)
+#   SALE_REVOKE_BENCHMARK_LINES: number of lines per sale (M)
+#   SALE_REVOKE_BENCHMARK_SHIPMENTS: number of partial shipments (K)
+BENCHMARK = bool(os.getenv('SALE_REVOKE_BENCHMARK'))
+SALES = int(os.getenv('SALE_REVOKE_BENCHMARK_SALES', 20))
+LINES = int(os.getenv('SALE_REVOKE_BENCHMARK_LINES', 3))
+SHIPMENTS = int(os.getenv('SALE_REVOKE_BENCHMARK_SHIPMENTS', 2))
+
+# The maximum queries of each operation and of each batch of a phase as a
+# fixed part and a part per sale, the batched phases must not grow with the
+# number of sales
+OPERATION_BUDGETS = {
+    "Revoke": (1200, 50),
+    "Revoke in background": (800, 45),
+    "Fix exception sales": (600, 30),
+    "Create pending moves": (250, 12),
+    }
+PHASE_BUDGETS = {
+    ('revoke', 'validate_moves'): (5, 0),
+    ('revoke', 'validate_invoices'): (5, 0),
+    ('revoke', 'invoice'): (300, 10),
+    ('revoke', 'invoice.cancel'): (200, 6),
+    ('revoke', 'invoice.ignore'): (50, 3),
+    ('revoke', 'invoice.process'): (100, 0),
+    ('revoke', 'shipment'): (500, 15),
+    ('revoke', 'shipment.draft'): (150, 2),
+    ('revoke', 'shipment.cancel'): (150, 2),
+    ('revoke', 'shipment.ignore'): (60, 12),
+    ('revoke', 'shipment.process'): (200, 1),
+    ('exception', 'process'): (75, 0),
+    ('exception', 'validation'): (25, 0),
+    ('exception', 'invoice'): (80, 0),
+    ('exception', 'invoice.cancel'): (20, 0),
+    ('exception', 'invoice.ignore'): (10, 0),
+    ('exception', 'invoice.process'): (60, 0),
+    ('exception', 'shipment'): (250, 15),
+    ('exception', 'shipment.draft'): (10, 0),
+    ('exception', 'shipment.cancel'): (20, 0),
+    ('exception', 'shipment.ignore'): (60, 12),
+    ('exception', 'shipment.process'): (120, 0),
+    }
+
+logger = logging.getLogger(__name__)
+
+# The queries are counted from the debug logs of the backend which must be
+# enabled before the connection to the database is opened
+if BENCHMARK:
+    for name in BACKEND_LOGGERS:
+        logging.getLogger(name).setLevel(logging.DEBUG)
+        logging.getLogger(name).propagate = False
+
+
+@unittest.skipUnless(BENCHMARK, "SALE_REVOKE_BENCHMARK is not set")
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+        self.counter = QueryCounter()
+        for name in BACKEND_LOGGERS:
+            logging.getLogger(name).addHandler(self.counter)
+
+    def tearDown(self):
+        for name in BACKEND_LOGGERS:
+            logging.getLogger(name).removeHandler(self.counter)
+        drop_db()
+        super().tearDown()
+
+    @contextmanager
+    def measure(self, name, sales):
+        count = self.counter.count
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+        queries = self.counter.count - count
+        logger.info("%s: %s sales, %s queries in %.3fs",
+            name, sales, queries, duration)
+        self.assertQueries(name, OPERATION_BUDGETS[name], sales, queries)
+
+    def assertQueries(self, name, budget, sales, queries):
+        fixed, per_sale = budget
+        with self.subTest(name=name, sales=sales):
+            self.assertLessEqual(queries, fixed + per_sale * sales)
+
+    def test(self):
+
+        today = dt.date.today()
+
+        # Activate modules
+        activate_modules('sale_revoke')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company, today - dt.timedelta(days=30)))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        revenue = accounts['revenue']
+        expense = accounts['expense']
+
+        # Create tax
+        tax = create_tax(Decimal('.10'))
+        tax.save()
+
+        # Create parties
+        Party = Model.get('party.party')
+        customer = Party(name='Customer')
+        customer.save()
+
+        # Create account categories
+        ProductCategory = Model.get('product.category')
+        account_category = ProductCategory(name="Account Category")
+        account_category.accounting = True
+        account_category.account_expense = expense
+        account_category.account_revenue = revenue
+        account_category.customer_taxes.append(tax)
+        account_category.save()
+
+        # Create products
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+        products = []
+        for i in range(LINES):
+            template = ProductTemplate()
+            template.name = 'product %s' % i
+            template.default_uom = unit
+            template.type = 'goods'
+            template.salable = True
+            template.list_price = Decimal('10')
+            template.account_category = account_category
+            template.save()
+            products.extend(template.products)
+
+        # Create payment term
+        payment_term = create_payment_term()
+        payment_term.save()
+
+        # Create an Inventory
+        Inventory = Model.get('stock.inventory')
+        Location = Model.get('stock.location')
+        storage, = Location.find([
+            ('code', '=', 'STO'),
+        ])
+        inventory = Inventory()
+        inventory.location = storage
+        for product in products:
+            inventory_line = inventory.lines.new(product=product)
+            inventory_line.quantity = 100000.0
+            inventory_line.expected_quantity = 0.0
+        inventory.click('confirm')
+        self.assertEqual(inventory.state, 'done')
+
+        Sale = Model.get('sale.sale')
+
+        def create_sale(kind):
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.sale_date = today - dt.timedelta(days=20)
+            if kind == 'blocked':
+                sale.invoice_method = 'order'
+            else:
+                sale.invoice_method = 'fulfillment'
+            for product in products:
+                sale_line = sale.lines.new()
+                sale_line.product = product
+                sale_line.quantity = float(SHIPMENTS + 1)
+            sale.click('quote')
+            sale.click('confirm')
+            if kind == 'draft':
+                shipment, = sale.shipments
+                shipment.click('draft')
+            elif kind == 'done':
+                # Ship one unit of each line on each partial shipment
+                for _ in range(SHIPMENTS):
+                    shipment, = [s for s in sale.shipments
+                        if s.state == 'waiting']
+                    for move in shipment.inventory_moves:
+                        move.quantity = 1
+                    shipment.click('assign_try')
+                    shipment.click('pick')
+                    shipment.click('pack')
+                    shipment.click('do')
+                    sale.reload()
+            elif kind == 'cancelled':
+                shipment, = sale.shipments
+                shipment.click('cancel')
+            elif kind == 'blocked':
+                shipment, = sale.shipments
+                shipment.click('assign_try')
+                invoice, = sale.invoices
+                invoice.click('cancel')
+            return sale
+
+        # Sales with waiting, draft and partially done shipments to revoke
+        kinds = ['waiting', 'draft', 'done']
+        revoke_sales = [create_sale(kinds[i % len(kinds)])
+            for i in range(SALES)]
+
+        # Exception sales with some sales blocked by an assigned shipment
+        kinds = ['cancelled', 'cancelled', 'cancelled', 'blocked']
+        exception_sales = [create_sale(kinds[i % len(kinds)])
+            for i in range(SALES)]
+
+        # Log the phases
+        Configuration = Model.get('sale.configuration')
+        configuration = Configuration(1)
+        configuration.sale_revoke_log = True
+        configuration.save()
+
+        # Revoke
+        revoke = Wizard('sale.sale.revoke', revoke_sales)
+        revoke.form.manage_invoices = True
+        with self.measure("Revoke", len(revoke_sales)):
+            revoke.execute('revoke')
+        for sale in revoke_sales:
+            sale.reload()
+            self.assertIn(sale.state, ['done', 'processing'])
+            self.assertTrue(sale.ignored_moves)
+
+        # Revoke in background
+        background_sales = [create_sale('waiting') for _ in range(SALES)]
+        revoke = Wizard('sale.sale.revoke', background_sales)
+        revoke.form.queued = True
+        with self.measure("Revoke in background", len(background_sales)):
+            revoke.execute('revoke')
+        for sale in background_sales:
+            sale.reload()
+            self.assertEqual(sale.revoke_state, 'done')
+
+        # Fix exception sales
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=', 'sale.sale|sale_exception_fix_cron'),
+                ('active', '=', False),
+                ])
+        cron.active = True
+        cron.save()
+        with self.measure("Fix exception sales", len(exception_sales)):
+            cron.click('run_once')
+        for sale, kind in zip(exception_sales, kinds * SALES):
+            sale.reload()
+            if kind == 'blocked':
+                self.assertEqual(sale.invoice_state, 'exception')
+            else:
+                self.assertEqual(sale.state, 'done')
+
+        # Create pending moves
+        pending_moves = Wizard('sale.sale.create_pending_moves', revoke_sales)
+        with self.measure("Create pending moves", len(revoke_sales)):
+            pending_moves.execute('create_')
+        self.assertEqual(
+            len(Sale.find([('state', '=', 'draft')])), len(revoke_sales))
+
+        # Check the queries of the logged phases of each batch
+        RevokeLog = Model.get('sale.revoke.log')
+        logs = RevokeLog.find([('sale', '=', None)])
+        self.assertTrue(logs)
+        for log in logs:
+            key = (log.operation, log.phase)
+            logger.info("%s: %s: %s sales, %s queries in %.3fs",
+                *key, log.sales, log.queries, log.duration)
+            self.assertQueries(
+                '%s: %s' % key, PHASE_BUDGETS[key], log.sales, log.queries)
@@ -1,11 +1,427 @@
 # This file is part sale_revoke module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.sale_revoke.sale import (
+    LOCK_RETRY_DELAY, MAX_RETRY_DAYS, savepoint)
+from trytond.model import Index
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_sale(company):
+    pool = Pool()
+    Party = pool.get('party.party')
+    Address = pool.get('party.address')
+    Sale = pool.get('sale.sale')
+
+    party = Party(name='Customer', addresses=[Address()])
+    party.save()
+    address, = party.addresses
+    sale = Sale(company=company, party=party,
+        invoice_address=address, shipment_address=address)
+    sale.save()
+    return sale
+
+
+def create_line_moves(sale, states):
+    "Create a line on the sale with a move in each state"
+    pool = Pool()
+    Line = pool.get('sale.line')
+    Move = pool.get('stock.move')
+    Location = pool.get('stock.location')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template = Template(name='Product', default_uom=unit, type='goods',
+        salable=True, sale_uom=unit, list_price=Decimal('10'),
+        products=[Product()])
+    template.save()
+    product, = template.products
+    storage, = Location.search([('code', '=', 'STO')])
+    customer, = Location.search([('code', '=', 'CUS')])
+
+    line = Line(sale=sale, product=product, quantity=len(states), unit=unit,
+        unit_price=Decimal('10'))
+    line.save()
+    moves = Move.create([{
+                'product': product.id,
+                'unit': unit.id,
+                'quantity': 1,
+                'from_location': storage.id,
+                'to_location': customer.id,
+                'company': sale.company.id,
+                'unit_price': Decimal('10'),
+                'currency': sale.company.currency.id,
+                'origin': str(line),
+                } for _ in states])
+    Move.cancel([m for m, s in zip(moves, states) if s == 'cancelled'])
+    return line, moves
 
 
 class SaleRevokeTestCase(ModuleTestCase):
     'Test Sale Revoke module'
     module = 'sale_revoke'
 
+    def assertRequeued(self, method, sale):
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+
+        task, = Queue.search([
+                ('data.model', '=', 'sale.sale'),
+                ('data.method', '=', method),
+                ])
+        self.assertEqual(list(task.data['instances']), [sale.id])
+        self.assertGreater(
+            task.scheduled_at,
+            dt.datetime.now() + LOCK_RETRY_DELAY - dt.timedelta(minutes=1))
+
+    @with_transaction()
+    def test_revoke_sales_contended(self):
+        "Test revoke sales re-queues the contended sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            sale.revoke_state = 'queued'
+            sale.save()
+
+            with patch.object(
+                    Sale, 'lock_revoke', return_value=([], [sale.id])):
+                Sale.revoke_sales([sale])
+
+            sale = Sale(sale.id)
+            self.assertEqual(sale.revoke_state, 'queued')
+            self.assertRequeued('revoke_sales', sale)
+
+    @with_transaction()
+    def test_revoke_sales_failed(self):
+        "Test revoke sales flags the sales as failed on error"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+
+            with patch.object(Sale, 'lock_revoke', side_effect=ValueError):
+                Sale.revoke_sales([sale])
+
+            sale = Sale(sale.id)
+            self.assertEqual(sale.revoke_state, 'failed')
+
+    @with_transaction()
+    def test_handle_sale_exceptions_contended(self):
+        "Test handle sale exceptions re-queues the contended sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+
+            with patch.object(
+                    Sale, 'lock_revoke', return_value=([], [sale.id])):
+                errors = Sale.handle_sale_exceptions([sale])
+
+            self.assertEqual(errors, {})
+            self.assertRequeued('handle_sale_exceptions', sale)
+
+    @with_transaction()
+    def test_handle_sale_exceptions_skipped(self):
+        "Test handle sale exceptions drops the sales claimed by a worker"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+
+            with patch.object(
+                    Sale, 'lock_revoke', return_value=([sale.id], [])):
+                with patch.object(Sale, 'process_states') as process_states:
+                    errors = Sale.handle_sale_exceptions([sale])
+
+            self.assertEqual(errors, {})
+            process_states.assert_not_called()
+            self.assertEqual(Queue.search([], count=True), 0)
+
+    @with_transaction()
+    def test_handle_sale_exceptions_fixed(self):
+        "Test handle sale exceptions skips the sales fixed since queued"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            sale, fixed_sale = [create_sale(company) for _ in range(2)]
+            Sale.write([sale, fixed_sale], {
+                    'state': 'processing',
+                    'sale_date': Date.today() - dt.timedelta(days=30),
+                    'shipment_state': 'exception',
+                    })
+            Sale.write([fixed_sale], {'shipment_state': 'sent'})
+
+            with patch.object(Sale, 'lock_revoke', return_value=([], [])):
+                with patch.object(Sale, 'process_states') as process_states:
+                    Sale.handle_sale_exceptions([sale, fixed_sale])
+
+            (sales,), _ = process_states.call_args_list[0]
+            self.assertEqual(sales, [sale])
+
+    @with_transaction()
+    def test_process_states(self):
+        "Test process states processes only the sales to change"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            Sale.write([sale], {
+                    'state': 'processing',
+                    'sale_date': dt.date.today(),
+                    })
+
+            with patch.object(
+                    Sale, 'process', side_effect=Sale.process) as process:
+                Sale.process_states([sale])
+                process.assert_called_once_with([sale])
+                self.assertEqual(sale.state, 'done')
+
+                process.reset_mock()
+                Sale.process_states([sale])
+                process.assert_not_called()
+
+    @with_transaction()
+    def test_update_exception_attempts(self):
+        "Test the delay of the next fix of the failed sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            sale.exception_attempts = 40
+            sale.save()
+            today = Date.today()
+
+            Sale._update_exception_attempts(
+                [sale], {sale.id: ('shipment', None)})
+            self.assertEqual(sale.exception_attempts, 41)
+            self.assertEqual(sale.exception_failure, 'shipment')
+            self.assertEqual(sale.exception_retry_date,
+                today + dt.timedelta(days=MAX_RETRY_DAYS))
+
+            Sale._update_exception_attempts(
+                [sale], {sale.id: ('invoice', None)}, retry=True)
+            self.assertEqual(sale.exception_attempts, 41)
+            self.assertEqual(sale.exception_failure, 'invoice')
+            self.assertEqual(sale.exception_retry_date,
+                today + dt.timedelta(days=MAX_RETRY_DAYS))
+
+            Sale._update_exception_attempts([sale], {})
+            self.assertEqual(sale.exception_attempts, 0)
+            self.assertEqual(sale.exception_retry_date, None)
+
+    @with_transaction()
+    def test_savepoint_rollback(self):
+        "Test savepoint restores the records of the transaction"
+        pool = Pool()
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        party = Party(name='Customer')
+        party.save()
+
+        with self.assertRaises(ValueError):
+            with savepoint('test'):
+                Party.create([{'name': 'Other'}])
+                Party.delete([party])
+                raise ValueError
+
+        self.assertEqual(
+            transaction.create_records['party.party'], [party.id])
+        self.assertEqual(transaction.delete_records['party.party'], set())
+        self.assertEqual(Party(party.id).name, 'Customer')
+        self.assertEqual(Party.search([], count=True), 1)
+
+    @with_transaction()
+    def test_unchanged_sale_exception_query(self):
+        "Test the query of the failed sales not changed since their fix"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            line = Line(sale=sale, type='comment', description="Comment")
+            line.save()
+            Sale.write([sale], {
+                    'state': 'processing',
+                    'sale_date': dt.date.today(),
+                    'exception_fingerprint': (
+                        dt.datetime.now() + dt.timedelta(days=1)),
+                    })
+
+            for kwargs, result in [
+                    ({}, [(sale.id,)]),
+                    ({'company': company.id}, [(sale.id,)]),
+                    ({'company': company.id + 1}, []),
+                    ({'sale_ids': [sale.id]}, [(sale.id,)]),
+                    ]:
+                cursor.execute(*Sale._unchanged_sale_exception_query(
+                        **kwargs))
+                self.assertEqual(cursor.fetchall(), result)
+
+            Sale.write([sale], {
+                    'exception_fingerprint': (
+                        dt.datetime.now() - dt.timedelta(days=1)),
+                    })
+            cursor.execute(*Sale._unchanged_sale_exception_query())
+            self.assertEqual(cursor.fetchall(), [])
+
+    @with_transaction()
+    def test_sale_exception_index(self):
+        "Test the partial index covers the exception sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        table = Sale.__table__()
+        cursor = Transaction().connection.cursor()
+
+        index = Index(
+            table,
+            (table.company, Index.Equality()),
+            (table.sale_date, Index.Range()),
+            (table.id, Index.Range()),
+            where=(table.state == 'processing')
+            & ((table.invoice_state == 'exception')
+                | (table.shipment_state == 'exception')))
+        self.assertIn(index, Sale._sql_indexes)
+
+        company = create_company()
+        with set_company(company):
+            sales = [create_sale(company) for _ in range(3)]
+            Sale.write(sales, {
+                    'state': 'processing',
+                    'sale_date': dt.date.today(),
+                    })
+            exception_sale, exception_invoice_sale, sale = sales
+            Sale.write([exception_sale], {'shipment_state': 'exception'},
+                [exception_invoice_sale], {'invoice_state': 'exception'})
+
+            cursor.execute(*table.select(table.id,
+                    where=index.options['where'], order_by=[table.id]))
+            self.assertEqual(
+                [i for i, in cursor],
+                [exception_sale.id, exception_invoice_sale.id])
+
+    @with_transaction()
+    def test_revoke_browse(self):
+        "Test the sales are browsed with a cache for all their lines"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            Line.save([Line(sale=sale, type='comment', description="Comment")
+                    for _ in range(3)])
+
+            with Transaction().set_context(_record_cache_size=1):
+                sale, = Sale._revoke_browse([sale.id])
+            self.assertEqual(sale._context['_record_cache_size'], 3)
+
+    @with_transaction()
+    def test_get_pending_moves(self):
+        "Test the pending moves are the cancelled moves left to handle"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            states = ['cancelled', 'cancelled', 'cancelled', 'draft']
+            line, moves = create_line_moves(sale, states)
+            other_line, other_moves = create_line_moves(sale, states)
+            line.moves_ignored = moves[:1]
+            line.save()
+            other_line.moves_recreated = other_moves[1:2]
+            other_line.save()
+
+            # The moves handled one line at a time
+            pending_moves = sorted((sale.id, l.id, m.id)
+                for l in Line.browse([line, other_line])
+                for m in l.moves
+                if m.state == 'cancelled'
+                and m not in l.moves_ignored
+                and m not in l.moves_recreated)
+            self.assertEqual(len(pending_moves), 4)
+            self.assertEqual(Sale.get_pending_moves([sale]), pending_moves)
+
+            with patch.object(Line, 'write', side_effect=Line.write) as write:
+                Sale.handle_shipments([sale])
+            write.assert_called_once()
+            self.assertEqual(Sale.get_pending_moves([sale]), [])
+            line, other_line = Line.browse([line, other_line])
+            self.assertEqual(
+                sorted(line.moves_ignored), sorted(moves[:3]))
+            self.assertEqual(
+                sorted(other_line.moves_ignored),
+                sorted([other_moves[0], other_moves[2]]))
+
+    @with_transaction()
+    def test_queued_sale_exceptions(self):
+        "Test the queued fixes of given sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company)
+            other_sale = create_sale(company)
+            Sale.__queue__.fix_scheduled_exceptions([sale])
+
+            self.assertEqual(Sale._queued_sale_exceptions(), {sale.id})
+            self.assertEqual(
+                Sale._queued_sale_exceptions([sale, other_sale]), {sale.id})
+            self.assertEqual(Sale._queued_sale_exceptions([other_sale]), set())
+
+    @with_transaction()
+    def test_enqueue_sale_exceptions_twice(self):
+        "Test enqueue the fix of the same sales twice"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            sales = [create_sale(company) for _ in range(3)]
+
+            enqueued = Sale._enqueue_sale_exceptions(sales)
+            self.assertEqual(enqueued, sales)
+            enqueued = Sale._enqueue_sale_exceptions(sales)
+            self.assertEqual(enqueued, [])
+
+            self.assertEqual(Queue.search([
+                        ('data.method', '=', 'handle_sale_exceptions'),
+                        ], count=True), 1)
+
+
 del ModuleTestCase
@@ -0,0 +1,336 @@
+import datetime as dt
+import unittest
+from decimal import Decimal
+
+from proteus import Model, Wizard
+from trytond.modules.account.tests.tools import (create_chart,
+                                                 create_fiscalyear, create_tax,
+                                                 get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        today = dt.date.today()
+
+        # Activate modules
+        activate_modules('sale_revoke')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company, today - dt.timedelta(days=30)))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        revenue = accounts['revenue']
+        expense = accounts['expense']
+
+        # Create tax
+        tax = create_tax(Decimal('.10'))
+        tax.save()
+
+        # Create parties
+        Party = Model.get('party.party')
+        customer = Party(name='Customer')
+        customer.save()
+
+        # Create account categories
+        ProductCategory = Model.get('product.category')
+        account_category = ProductCategory(name="Account Category")
+        account_category.accounting = True
+        account_category.account_expense = expense
+        account_category.account_revenue = revenue
+        account_category.customer_taxes.append(tax)
+        account_category.save()
+
+        # Create product
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+        template = ProductTemplate()
+        template.name = 'product'
+        template.default_uom = unit
+        template.type = 'goods'
+        template.salable = True
+        template.list_price = Decimal('10')
+        template.account_category = account_category
+        template.save()
+        product, = template.products
+
+        # Create payment term
+        payment_term = create_payment_term()
+        payment_term.save()
+
+        # Create an Inventory
+        Inventory = Model.get('stock.inventory')
+        Location = Model.get('stock.location')
+        storage, = Location.find([
+            ('code', '=', 'STO'),
+        ])
+        inventory = Inventory()
+        inventory.location = storage
+        inventory_line = inventory.lines.new(product=product)
+        inventory_line.quantity = 100.0
+        inventory_line.expected_quantity = 0.0
+        inventory.click('confirm')
+        self.assertEqual(inventory.state, 'done')
+
+        # Sales with a cancelled shipment
+        Sale = Model.get('sale.sale')
+        sales = []
+        for quantity in [2.0, 3.0, 4.0]:
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.sale_date = today - dt.timedelta(days=20)
+            sale.invoice_method = 'fulfillment'
+            sale_line = sale.lines.new()
+            sale_line.product = product
+            sale_line.quantity = quantity
+            sale.click('quote')
+            sale.click('confirm')
+            shipment, = sale.shipments
+            shipment.click('cancel')
+            sale.reload()
+            self.assertEqual(sale.shipment_state, 'exception')
+            sales.append(sale)
+
+        # Sale with a cancelled invoice and an assigned shipment
+        blocked_sale = Sale()
+        blocked_sale.party = customer
+        blocked_sale.payment_term = payment_term
+        blocked_sale.sale_date = today - dt.timedelta(days=20)
+        blocked_sale.invoice_method = 'order'
+        sale_line = blocked_sale.lines.new()
+        sale_line.product = product
+        sale_line.quantity = 5.0
+        blocked_sale.click('quote')
+        blocked_sale.click('confirm')
+        shipment, = blocked_sale.shipments
+        shipment.click('assign_try')
+        invoice, = blocked_sale.invoices
+        invoice.click('cancel')
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.invoice_state, 'exception')
+        self.assertEqual(blocked_sale.revocation_status, 'blocked_moves')
+
+        # Recent sale with a cancelled shipment
+        recent_sale = Sale()
+        recent_sale.party = customer
+        recent_sale.payment_term = payment_term
+        recent_sale.invoice_method = 'fulfillment'
+        sale_line = recent_sale.lines.new()
+        sale_line.product = product
+        sale_line.quantity = 1.0
+        recent_sale.click('quote')
+        recent_sale.click('confirm')
+        shipment, = recent_sale.shipments
+        shipment.click('cancel')
+
+        # Run the fix exception sales cron by batches of 2 sales and one
+        # partition per warehouse
+        Configuration = Model.get('sale.configuration')
+        configuration = Configuration(1)
+        configuration.sale_exception_batch_size = 2
+        configuration.sale_exception_partition = 'warehouse'
+        configuration.sale_revoke_log = True
+        configuration.save()
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=', 'sale.sale|sale_exception_fix_cron'),
+                ('active', '=', False),
+                ])
+        cron.active = True
+        cron.save()
+        cron.click('run_once')
+
+        for sale in sales:
+            sale.reload()
+            self.assertEqual(sale.state, 'done')
+            self.assertEqual(sale.shipment_state, 'none')
+            self.assertEqual(len(sale.ignored_moves), 1)
+
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.state, 'processing')
+        self.assertEqual(blocked_sale.invoice_state, 'exception')
+        shipment, = blocked_sale.shipments
+        self.assertEqual(shipment.state, 'assigned')
+
+        recent_sale.reload()
+        self.assertEqual(recent_sale.shipment_state, 'exception')
+
+        # The phases of the fix are logged
+        RevokeLog = Model.get('sale.revoke.log')
+        logs = RevokeLog.find([('operation', '=', 'exception')])
+        self.assertEqual(
+            {l.phase for l in logs if not l.sale},
+            {'process', 'validation', 'shipment', 'invoice',
+                'shipment.draft', 'shipment.cancel', 'shipment.ignore',
+                'shipment.process', 'invoice.cancel', 'invoice.ignore',
+                'invoice.process'})
+        self.assertEqual(sum(l.sales for l in logs if l.phase == 'process'
+                and not l.failed and not l.sale), 4)
+        failed, = [l for l in logs if l.failed and l.sale]
+        self.assertEqual(failed.phase, 'validation')
+        self.assertEqual(failed.sale, blocked_sale)
+
+        # The outcome of each sale is stored on the run
+        Run = Model.get('sale.revoke.run')
+        run, = Run.find([])
+        self.assertEqual(run.company, company)
+        self.assertEqual(run.warehouse, blocked_sale.warehouse)
+        self.assertEqual((run.sales, run.fixed, run.failed), (4, 3, 1))
+        self.assertEqual(run.failure_rate, 0.25)
+        line, = [l for l in run.lines if l.outcome != 'fixed']
+        self.assertEqual(line.sale, blocked_sale)
+        self.assertEqual(line.outcome, 'validation')
+        self.assertIn('cannot revoke', line.message)
+
+        # The failed sale is delayed
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.exception_attempts, 1)
+        self.assertEqual(blocked_sale.exception_failure, 'validation')
+        self.assertEqual(
+            blocked_sale.exception_retry_date, today + dt.timedelta(days=1))
+        self.assertTrue(blocked_sale.exception_fingerprint)
+        cron.click('run_once')
+        self.assertEqual(len(Run.find([])), 1)
+
+        # Retried once reset
+        blocked_sale.click('reset_exception_attempts')
+        self.assertEqual(blocked_sale.exception_attempts, 0)
+        cron.click('run_once')
+        self.assertEqual(len(Run.find([])), 2)
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.exception_attempts, 1)
+
+        # Plan the fix of the failed sale
+        fix_exception = Wizard('sale.sale.fix_exception', [blocked_sale])
+        self.assertEqual(fix_exception.form.sales, 1)
+        self.assertEqual(fix_exception.form.blocked, 1)
+        self.assertIn(
+            '%s: blocked' % blocked_sale.rec_name, fix_exception.form.details)
+        fix_exception.execute('end')
+
+        # Retry the failed sales once unblocked
+        shipment, = blocked_sale.shipments
+        shipment.click('wait')
+        run.click('retry')
+        retry_run, = Run.find([('origin', '=', run.id)])
+        self.assertEqual((retry_run.sales, retry_run.fixed), (1, 1))
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.state, 'done')
+        self.assertEqual(blocked_sale.exception_attempts, 0)
+        self.assertEqual(blocked_sale.exception_retry_date, None)
+        self.assertEqual(blocked_sale.exception_fingerprint, None)
+
+        # Schedule the fix when a sale gets an exception
+        configuration.sale_exception_schedule = True
+        configuration.save()
+        scheduled_sales = []
+        for sale_date in [today - dt.timedelta(days=20), today]:
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.sale_date = sale_date
+            sale.invoice_method = 'fulfillment'
+            sale_line = sale.lines.new()
+            sale_line.product = product
+            sale_line.quantity = 1.0
+            sale.click('quote')
+            sale.click('confirm')
+            shipment, = sale.shipments
+            shipment.click('cancel')
+            scheduled_sales.append(sale)
+        old_sale, new_sale = scheduled_sales
+        old_sale.reload()
+        self.assertEqual(old_sale.state, 'done')
+        self.assertEqual(len(old_sale.ignored_moves), 1)
+        new_sale.reload()
+        self.assertEqual(new_sale.shipment_state, 'exception')
+
+        # Plan and fix the exception of a sale before its margin
+        fix_exception = Wizard('sale.sale.fix_exception', [new_sale])
+        self.assertEqual(fix_exception.form.sales, 1)
+        self.assertEqual(fix_exception.form.blocked, 0)
+        self.assertEqual(fix_exception.form.moves_ignore, 1)
+        fix_exception.execute('fix')
+        new_sale.reload()
+        self.assertEqual(new_sale.state, 'done')
+        self.assertEqual(len(new_sale.ignored_moves), 1)
+
+        # Split the exception sales in shards
+        configuration.sale_exception_schedule = False
+        configuration.sale_exception_shards = 2
+        configuration.save()
+        sharded_sales = []
+        for _ in range(2):
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.sale_date = today - dt.timedelta(days=20)
+            sale.invoice_method = 'fulfillment'
+            sale_line = sale.lines.new()
+            sale_line.product = product
+            sale_line.quantity = 1.0
+            sale.click('quote')
+            sale.click('confirm')
+            shipment, = sale.shipments
+            shipment.click('cancel')
+            sharded_sales.append(sale)
+        cron.click('run_once')
+        runs = Run.find([('shards', '=', 2)])
+        self.assertEqual(sorted(r.shard for r in runs), [0, 1])
+        self.assertEqual([r.sales for r in runs], [1, 1])
+        for sale in sharded_sales:
+            sale.reload()
+            self.assertEqual(sale.state, 'done')
+
+        # Limit the number of sales enqueued by run
+        configuration.sale_exception_shards = None
+        configuration.sale_exception_max_sales = 1
+        configuration.save()
+        limited_sales = []
+        for _ in range(2):
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.sale_date = today - dt.timedelta(days=20)
+            sale.invoice_method = 'fulfillment'
+            sale_line = sale.lines.new()
+            sale_line.product = product
+            sale_line.quantity = 1.0
+            sale.click('quote')
+            sale.click('confirm')
+            shipment, = sale.shipments
+            shipment.click('cancel')
+            limited_sales.append(sale)
+        first_sale, second_sale = limited_sales
+        cron.click('run_once')
+        first_sale.reload()
+        self.assertEqual(first_sale.state, 'done')
+        second_sale.reload()
+        self.assertEqual(second_sale.shipment_state, 'exception')
+        cron.click('run_once')
+        second_sale.reload()
+        self.assertEqual(second_sale.state, 'done')
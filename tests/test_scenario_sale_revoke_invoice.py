@@ -149,6 +149,34 @@ class Test(unittest.TestCase):
         invoice_line, = invoice.lines
         self.assertEqual(len(invoice_line.stock_moves), 0)
 
+        # Revoke invoices of several sales at once
+        sales = []
+        for quantity in [2.0, 3.0]:
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.shipment_method = 'invoice'
+            sale_line = sale.lines.new()
+            sale_line.product = product
+            sale_line.quantity = quantity
+            sale.click('quote')
+            sale.click('confirm')
+            sales.append(sale)
+
+        revoke_sales = Wizard('sale.sale.revoke', sales)
+        revoke_sales.form.manage_invoices = True
+        revoke_sales.execute('plan')
+        self.assertEqual(revoke_sales.form.invoices_cancel, 2)
+        self.assertEqual(revoke_sales.form.invoices_ignore, 2)
+        self.assertEqual(revoke_sales.form.shipments_cancel, 0)
+        revoke_sales.execute('revoke')
+        for sale in sales:
+            sale.reload()
+            self.assertEqual(sale.invoice_state, 'none')
+            invoice, = sale.invoices
+            self.assertEqual(invoice.state, 'cancelled')
+            self.assertEqual(sale.invoices_ignored, [invoice])
+
         # Sale and raise UserError when revoking
         sale = Sale()
         sale.party = customer
@@ -149,6 +149,7 @@ class Test(unittest.TestCase):
         self.assertEqual(len(sale.shipments), 1)
         self.assertEqual(len(sale.shipment_returns), 1)
         self.assertEqual(len(sale.invoices), 0)
+        self.assertEqual(sale.revocation_status, 'revocable')
 
         # Revoke sale and create pending moves
         revoke_sales = Wizard('sale.sale.revoke', [sale])
@@ -161,12 +162,15 @@ class Test(unittest.TestCase):
         shipment_returns, = sale.shipment_returns
         self.assertEqual(shipment_returns.state, 'cancelled')
 
-        Wizard('sale.sale.create_pending_moves', [sale])
+        pending_moves = Wizard('sale.sale.create_pending_moves', [sale])
+        pending_moves.execute('create_')
         sales = Sale.find([], order=[('id', 'ASC')])
         self.assertEqual(len(sales), 2)
 
         sale1, sale2 = sales
         self.assertEqual((sale1.state, sale2.state), ('done', 'draft'))
+        self.assertEqual(sale1.revocation_status, 'ignored_moves')
+        self.assertEqual(sale2.revocation_status, None)
 
         # Sale and partial shipment
         sale = Sale()
@@ -225,11 +229,87 @@ class Test(unittest.TestCase):
         self.assertEqual((shipment1.state, shipment2.state),
                          ('done', 'cancelled'))
 
-        Wizard('sale.sale.create_pending_moves', [sale])
+        pending_moves = Wizard('sale.sale.create_pending_moves', [sale])
+        pending_moves.execute('create_')
         sales = Sale.find([], order=[('id', 'ASC')])
         new_sale = sales[-1]
         self.assertEqual(new_sale.lines[0].quantity, 7.0)
 
+        # Revoke several sales at once
+        sales = []
+        for quantity in [4.0, 6.0]:
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.invoice_method = 'fulfillment'
+            sale_line = SaleLine()
+            sale.lines.append(sale_line)
+            sale_line.product = product
+            sale_line.quantity = quantity
+            sale_line = SaleLine()
+            sale.lines.append(sale_line)
+            sale_line.type = 'comment'
+            sale_line.description = 'Comment'
+            sale.click('quote')
+            sale.click('confirm')
+            sales.append(sale)
+
+        revoke_sales = Wizard('sale.sale.revoke', sales)
+        revoke_sales.execute('plan')
+        self.assertEqual(revoke_sales.form.sales, 2)
+        self.assertEqual(revoke_sales.form.blocked, 0)
+        self.assertEqual(revoke_sales.form.shipments_draft, 2)
+        self.assertEqual(revoke_sales.form.shipments_cancel, 2)
+        self.assertEqual(revoke_sales.form.moves_ignore, 2)
+        revoke_sales.execute('revoke')
+        for sale in sales:
+            sale.reload()
+            self.assertEqual(sale.state, 'done')
+            self.assertEqual(sale.shipment_state, 'none')
+            shipment, = sale.shipments
+            self.assertEqual(shipment.state, 'cancelled')
+            self.assertEqual(len(sale.ignored_moves), 1)
+
+        # Revoke a sale in background
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'fulfillment'
+        sale_line = SaleLine()
+        sale.lines.append(sale_line)
+        sale_line.product = product
+        sale_line.quantity = 2.0
+        sale.click('quote')
+        sale.click('confirm')
+        revoke_sales = Wizard('sale.sale.revoke', [sale])
+        revoke_sales.form.queued = True
+        revoke_sales.execute('revoke')
+        sale.reload()
+        self.assertEqual(sale.revoke_state, 'done')
+        self.assertEqual(sale.state, 'done')
+        shipment, = sale.shipments
+        self.assertEqual(shipment.state, 'cancelled')
+
+        # Search sales with ignored moves
+        ignored_sales = Sale.find([('ignored_moves', '!=', None)])
+        for sale in sales:
+            self.assertIn(sale, ignored_sales)
+        self.assertNotIn(new_sale, ignored_sales)
+        self.assertIn(new_sale, Sale.find([('ignored_moves', '=', None)]))
+
+        # Create pending moves of several sales at once
+        pending_moves = Wizard('sale.sale.create_pending_moves', sales)
+        self.assertFalse(pending_moves.form.only_pending_lines)
+        pending_moves.form.only_pending_lines = True
+        pending_moves.execute('create_')
+        pending_sales = Sale.find([], order=[('id', 'ASC')])[-2:]
+        self.assertEqual(
+            [l.quantity for s in pending_sales for l in s.lines], [4.0, 6.0])
+        self.assertEqual([s.state for s in pending_sales], ['draft', 'draft'])
+        ignored_move = sales[0].ignored_moves[0]
+        self.assertEqual(
+            Sale.find([('ignored_moves', '=', ignored_move.id)]), [sales[0]])
+
         # Sale and raise UserError when revoking
         sale = Sale()
         sale.party = customer
@@ -243,6 +323,10 @@ class Test(unittest.TestCase):
         sale.click('confirm')
         shipment, = sale.shipments
         shipment.click('assign_try')
+        sale.reload()
+        self.assertEqual(sale.revocation_status, 'blocked_moves')
+        self.assertEqual(
+            Sale.find([('revocation_status', '=', 'blocked_moves')]), [sale])
         revoke_sales = Wizard('sale.sale.revoke', [sale])
 
         with self.assertRaises(UserError):
@@ -255,3 +339,62 @@ class Test(unittest.TestCase):
 
         sale.reload()
         self.assertEqual(sale.shipment_state, 'waiting')
+
+        # Sale more products than in stock
+        scarce_template, = product.template.duplicate(
+            default={'name': 'scarce product'})
+        scarce_product, = scarce_template.products
+        inventory = Inventory()
+        inventory.location = storage
+        inventory_line = inventory.lines.new(product=scarce_product)
+        inventory_line.quantity = 3.0
+        inventory_line.expected_quantity = 0.0
+        inventory.click('confirm')
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'fulfillment'
+        sale_line = sale.lines.new()
+        sale_line.product = scarce_product
+        sale_line.quantity = 5.0
+        sale.click('quote')
+        sale.click('confirm')
+        shipment, = sale.shipments
+        shipment.click('assign_try')
+        self.assertEqual(shipment.state, 'waiting')
+        self.assertIn(
+            'assigned', [m.state for m in shipment.inventory_moves])
+        sale.reload()
+        self.assertEqual(sale.revocation_status, 'blocked_moves')
+        revoke_sales = Wizard('sale.sale.revoke', [sale])
+        with self.assertRaises(UserError):
+            revoke_sales.execute('revoke')
+
+        # Revoke blocked and revocable sales at once
+        blocked_sale = sale
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'fulfillment'
+        sale_line = sale.lines.new()
+        sale_line.product = product
+        sale_line.quantity = 1.0
+        sale.click('quote')
+        sale.click('confirm')
+        revoke_sales = Wizard('sale.sale.revoke', [blocked_sale, sale])
+        revoke_sales.execute('plan')
+        self.assertEqual(revoke_sales.form.sales, 2)
+        self.assertEqual(revoke_sales.form.blocked, 1)
+        self.assertEqual(revoke_sales.form.shipments_cancel, 1)
+        self.assertIn(
+            '%s: blocked' % blocked_sale.rec_name, revoke_sales.form.details)
+        self.assertNotIn(
+            '%s: blocked' % sale.rec_name, revoke_sales.form.details)
+        with self.assertRaises(UserError):
+            revoke_sales.execute('revoke')
+        revoke_sales = Wizard('sale.sale.revoke', [sale])
+        revoke_sales.execute('revoke')
+        sale.reload()
+        self.assertEqual(sale.state, 'done')
+        blocked_sale.reload()
+        self.assertEqual(blocked_sale.state, 'processing')